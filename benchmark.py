@@ -0,0 +1,75 @@
+"""
+Micro-benchmarks of facebook_api without database and network.
+
+Example usage:
+
+    $ python benchmark.py parse
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+from django.conf import settings
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+
+def setup():
+    sys.path.insert(0, DIRNAME)
+    settings.configure(
+        DEBUG=False,
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        INSTALLED_APPS=('django.contrib.contenttypes', 'facebook_api'),
+        SOCIAL_API_TOKENS_STORAGES=[],
+    )
+    import django
+    django.setup()
+
+
+def get_models():
+    from django.db import models
+    from facebook_api.models import FacebookGraphIDModel, FacebookGraphManager
+
+    class BenchmarkPost(FacebookGraphIDModel):
+        message = models.TextField()
+        type = models.CharField(max_length=20)
+        likes_count = models.PositiveIntegerField(null=True)
+        shares_count = models.PositiveIntegerField(null=True)
+        created_time = models.DateTimeField(null=True)
+        updated_time = models.DateTimeField(null=True)
+
+        remote = FacebookGraphManager()
+
+        class Meta:
+            app_label = 'facebook_api'
+
+    return BenchmarkPost
+
+
+def benchmark_parse(number):
+    BenchmarkPost = get_models()
+    resources = [{
+        'id': '19292868552_%d' % i,
+        'message': '  Message of the post %d  ' % i,
+        'type': 'status',
+        'likes_count': str(i),
+        'shares_count': i,
+        'created_time': '2015-10-%02dT10:%02d:00+0000' % (i % 28 + 1, i % 60),
+        'updated_time': '2015-10-%02dT11:%02d:00+0000' % (i % 28 + 1, i % 60),
+        'unknown_field': 'value',
+    } for i in range(1000)]
+
+    seconds = min(timeit.repeat(lambda: BenchmarkPost.remote.parse_response_list(resources), number=number, repeat=3))
+    print('parse: %.1f usec per resource' % (seconds / number / len(resources) * 10 ** 6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks of facebook_api.")
+    parser.add_argument('benchmarks', nargs='+', choices=['parse'])
+    parser.add_argument('--number', type=int, default=10)
+    args = parser.parse_args()
+    setup()
+    for name in args.benchmarks:
+        globals()['benchmark_%s' % name](args.number)
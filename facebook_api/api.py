@@ -13,22 +13,315 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
-from facebook import GraphAPI, GraphAPIError as FacebookError
+import json
+from collections import deque
+import re
+import threading
+import time
+from urllib import urlencode
+from urlparse import parse_qs
+
+import requests
+from django.conf import settings
+from facebook import GraphAPI, GraphAPIError as FacebookError, FACEBOOK_GRAPH_URL
 from social_api.api import ApiAbstractBase, Singleton
 
-__all__ = ['api_call', 'FacebookError']
+from .cache import CACHE_STALE_TTL, CACHE_TTL, CachedResponse, get_response_cache
+from .session import get_session
 
+__all__ = ['api_call', 'api_call_batch', 'FacebookError']
 
-class FacebookApi(ApiAbstractBase):
-    __metaclass__ = Singleton
+RATE_LIMIT_THRESHOLD = getattr(settings, 'FACEBOOK_API_RATE_LIMIT_THRESHOLD', 75)
+RATE_LIMIT_MAX_DELAY = getattr(settings, 'FACEBOOK_API_RATE_LIMIT_MAX_DELAY', 600)
+# usage of one call in percents, until it's measured from reported usages
+RATE_LIMIT_CALL_COST = getattr(settings, 'FACEBOOK_API_RATE_LIMIT_CALL_COST', 1)
+# number of items, added to decreased page size after every successful fast response
+PAGE_SIZE_INCREASE = getattr(settings, 'FACEBOOK_API_PAGE_SIZE_INCREASE', 50)
+# time of response in seconds, after which response is counted as failed
+PAGE_SIZE_MAX_LATENCY = getattr(settings, 'FACEBOOK_API_PAGE_SIZE_MAX_LATENCY', 20)
+# share of errors and slow responses among the last PAGE_SIZE_WINDOW ones, above which page size is not increased
+# and is decreased after slow response
+PAGE_SIZE_MAX_ERROR_RATE = getattr(settings, 'FACEBOOK_API_PAGE_SIZE_MAX_ERROR_RATE', 0.2)
+PAGE_SIZE_WINDOW = getattr(settings, 'FACEBOOK_API_PAGE_SIZE_WINDOW', 20)
+
+# response for conditional request, if resource was not modified
+NOT_MODIFIED = object()
+
+
+class FacebookGraphAPI(GraphAPI):
+    """
+    GraphAPI, which sends requests through the shared pooled session and keeps headers of the last response.
+    If `request_etag` is defined, request is conditional and NOT_MODIFIED is returned for not modified resource
+    """
+    response_headers = None
+    request_etag = None
+
+    def request(self, path, args=None, post_args=None, files=None, method=None):
+        args = args or {}
+
+        if post_args is not None:
+            method = 'POST'
+
+        if self.access_token:
+            if post_args is not None:
+                post_args['access_token'] = self.access_token
+            else:
+                args['access_token'] = self.access_token
+
+        headers = {'If-None-Match': self.request_etag} if self.request_etag else None
+
+        self.response_headers = None
+        try:
+            response = get_session().request(method or 'GET', FACEBOOK_GRAPH_URL + path, timeout=self.timeout,
+                                             params=args, data=post_args, proxies=self.proxies, files=files,
+                                             headers=headers)
+        except requests.HTTPError as e:
+            raise FacebookError(json.loads(e.read()))
+
+        self.response_headers = response.headers
+        if response.status_code == 304:
+            return NOT_MODIFIED
+        return self.get_result(response)
+
+    def get_result(self, response):
+        headers = response.headers
+        if 'json' in headers['content-type']:
+            result = response.json()
+        elif 'image/' in headers['content-type']:
+            result = {'data': response.content, 'mime-type': headers['content-type'], 'url': response.url}
+        elif 'access_token' in parse_qs(response.text):
+            query_str = parse_qs(response.text)
+            result = {'access_token': query_str['access_token'][0]}
+            if 'expires' in query_str:
+                result['expires'] = query_str['expires'][0]
+        else:
+            raise FacebookError('Maintype was not text, image, or querystring')
+
+        if result and isinstance(result, dict) and result.get('error'):
+            raise FacebookError(result)
+        return result
+
+
+class FacebookRateLimitGovernor(object):
+    """
+    Governor of calls rate based on usage of application and access tokens, reported by Graph API in headers
+    `X-App-Usage` and `X-Page-Usage` in percents of the hourly limits.
+    Usage works as a bucket, which is filled by reported values and is emptied evenly during the hour.
+    When usage is over `threshold` calls are spread over the rest of the bucket: delay of every call grows
+    gradually from zero at threshold to the time of emptying the bucket by cost of one call at 100%,
+    when calls go at the rate of emptying. Cost of call is measured from growth of reported usages
+    """
+    app_key = 'app'
+    window = 3600
+    # weight of the last measured cost of call in its moving average
+    cost_smoothing = 0.2
+
+    def __init__(self, threshold=RATE_LIMIT_THRESHOLD, max_delay=RATE_LIMIT_MAX_DELAY, call_cost=RATE_LIMIT_CALL_COST):
+        self.threshold = threshold
+        self.max_delay = max_delay
+        self.call_cost = call_cost
+        self.usages = {}
+        self.costs = {}
+        self.lock = threading.Lock()
+
+    def get_header_usage(self, headers, name):
+        try:
+            return max(json.loads(headers[name]).values() or [0])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def update(self, token, headers):
+        if not headers:
+            return
+        for key, name in [(self.app_key, 'x-app-usage'), (token, 'x-page-usage')]:
+            usage = self.get_header_usage(headers, name)
+            if usage is not None:
+                self.set_usage(key, usage)
+
+    def set_usage(self, key, usage):
+        with self.lock:
+            if key in self.usages:
+                cost = self.get_cost(key)
+                self.costs[key] = cost + (max(0, usage - self.get_usage(key)) - cost) * self.cost_smoothing
+            self.usages[key] = (usage, time.time())
+
+    def set_limit_reached(self, key):
+        """
+        Mark usage as full after error of reached limit. Cost of call is doubled, because it was underestimated,
+        so delays of repeated errors grow exponentially
+        """
+        with self.lock:
+            self.costs[key] = self.get_cost(key) * 2
+            self.usages[key] = (100, time.time())
+
+    def get_cost(self, key):
+        return self.costs.get(key, self.call_cost)
+
+    def get_usage(self, key):
+        try:
+            usage, timestamp = self.usages[key]
+        except KeyError:
+            return 0
+        return max(0, usage - (time.time() - timestamp) * 100. / self.window)
+
+    def get_delay(self, token):
+        """
+        Return number of seconds to wait before the next call with the token
+        """
+        delays = [0]
+        for key in [self.app_key, token]:
+            usage = self.get_usage(key)
+            if usage > self.threshold:
+                fullness = min(1, (usage - self.threshold) / (100. - self.threshold))
+                delays += [fullness * self.get_cost(key) * self.window / 100.]
+        return min(self.max_delay, max(delays))
+
+    def get_best_token(self, tokens):
+        return min(tokens, key=self.get_usage)
+
+
+rate_limit_governor = FacebookRateLimitGovernor()
+
+
+class FacebookPageSizeController(object):
+    """
+    Controller of page size (argument `limit`) of requests to resources like `{id}/likes`. Size is halved after
+    every error and after slow response, if rate of errors and slow responses among the last `window` ones is
+    above `max_error_rate`. While the rate is low, size is increased by `increase` items after every fast
+    successful response, until it reaches limit requested before the first error. Decreased sizes are kept
+    between calls
+    """
+    def __init__(self, increase=PAGE_SIZE_INCREASE, decrease=0.5, max_latency=PAGE_SIZE_MAX_LATENCY,
+                 max_error_rate=PAGE_SIZE_MAX_ERROR_RATE, window=PAGE_SIZE_WINDOW):
+        self.increase = increase
+        self.decrease = decrease
+        self.max_latency = max_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.sizes = {}
+        self.ceilings = {}
+        # the last outcomes of requests of resource, True for errors and slow responses
+        self.outcomes = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, path):
+        """
+        Return resource path without version and graph ids
+        """
+        path = re.sub(r'^/?v\d+\.\d+/', '', unicode(path))
+        return re.sub(r'(^|/)\d+(_\d+)*(?=/|$)', r'\1{id}', path)
+
+    def get_limit(self, path, limit):
+        size = self.sizes.get(self.get_key(path))
+        return min(limit, size) if size else limit
+
+    def get_error_rate(self, path):
+        outcomes = self.outcomes.get(self.get_key(path))
+        return float(sum(outcomes)) / len(outcomes) if outcomes else 0
+
+    def add_outcome(self, key, failed):
+        if key not in self.outcomes:
+            self.outcomes[key] = deque(maxlen=self.window)
+        self.outcomes[key].append(failed)
+
+    def decrease_size(self, key, limit):
+        if key not in self.sizes:
+            self.ceilings[key] = limit
+        size = max(1, int(min(limit, self.sizes.get(key, limit)) * self.decrease))
+        self.sizes[key] = size
+        return size
+
+    def error(self, path, limit):
+        """
+        Decrease page size of resource after error, return new limit
+        """
+        key = self.get_key(path)
+        with self.lock:
+            self.add_outcome(key, True)
+            return self.decrease_size(key, limit)
+
+    def success(self, path, limit, latency=None):
+        """
+        Increase page size of resource after fast response or decrease it after slow one, depending on error rate.
+        Latency should be time of HTTP request only, without waiting for rate limit and parsing
+        """
+        slow = latency is not None and latency > self.max_latency
+        key = self.get_key(path)
+        with self.lock:
+            self.add_outcome(key, slow)
+            if self.get_error_rate(path) > self.max_error_rate:
+                if slow:
+                    self.decrease_size(key, limit)
+                return
+            if slow or key not in self.sizes:
+                return
+            size = self.sizes[key] + self.increase
+            if size >= self.ceilings[key]:
+                del self.sizes[key]
+            else:
+                self.sizes[key] = size
+
+
+page_size_controller = FacebookPageSizeController()
+
+
+class FacebookApiBase(ApiAbstractBase):
 
     provider = 'facebook'
     error_class = FacebookError
     sleep_repeat_error_messages = ['An unexpected error has occurred. Please retry your request later']
     version = 2.3
+    # maximum number of requests in one batch request, limited by Facebook
+    batch_requests_limit = 50
+    # access token for all calls of instance, if it's not used yet
+    token = None
+    governor = rate_limit_governor
+    page_size_controller = page_size_controller
+    # time to live of cached responses in seconds, could be overridden by argument `cache_ttl` of call
+    cache_ttl = CACHE_TTL
+    # key and ETag of cached response of the current call
+    cache_key = None
+    etag = None
 
     def call(self, method, methods_access_tag=None, *args, **kwargs):
-        response = super(FacebookApi, self).call(method, methods_access_tag=methods_access_tag, *args, **kwargs)
+        cache_ttl = kwargs.pop('cache_ttl', None)
+        if cache_ttl is None:
+            cache_ttl = self.cache_ttl
+
+        if cache_ttl and not self.cache_key and 'batch' not in kwargs:
+            return self.call_cached(cache_ttl, method, methods_access_tag, *args, **kwargs)
+        return self.call_remote(method, methods_access_tag, *args, **kwargs)
+
+    def call_cached(self, cache_ttl, method, methods_access_tag=None, *args, **kwargs):
+        """
+        Return response from cache if it's not expired, otherwise make conditional request with ETag of cached response.
+        Not modified responses are returned as CachedResponse instances
+        """
+        cache = get_response_cache()
+        key = cache.get_key(method, self.version, kwargs)
+        entry = cache.get(key)
+        if entry and entry['expires'] > time.time():
+            return CachedResponse(entry['response'])
+
+        self.cache_key = key
+        self.etag = entry['etag'] if entry else None
+        try:
+            response = self.call_remote(method, methods_access_tag, *args, **kwargs)
+            headers = self.api.response_headers or {}
+        finally:
+            self.cache_key = self.etag = None
+
+        if response is NOT_MODIFIED:
+            response = CachedResponse(entry['response'])
+
+        if isinstance(response, dict):
+            entry = {'response': dict(response), 'etag': headers.get('etag'), 'expires': time.time() + cache_ttl}
+            cache.set(key, entry, cache_ttl + CACHE_STALE_TTL)
+
+        return response
+
+    def call_remote(self, method, methods_access_tag=None, *args, **kwargs):
+        response = super(FacebookApiBase, self).call(method, methods_access_tag=methods_access_tag, *args, **kwargs)
 
         # TODO: check if its heritage of previous api lib pyfacegraph
         if getattr(response, 'error_code', None):
@@ -41,25 +334,106 @@ class FacebookApi(ApiAbstractBase):
 
         return response
 
+    def get_token(self):
+        if self.token and self.token not in self.used_access_tokens:
+            return self.token
+        token = super(FacebookApiBase, self).get_token()
+
+        # try to find not limited token
+        if self.governor.get_delay(token) and self.tokens:
+            tokens = list(set(self.tokens).difference(set(self.used_access_tokens))) or [token]
+            token = self.governor.get_best_token(tokens)
+        return token
+
     def get_api(self, token):
-        return GraphAPI(access_token=token, version=self.version)
+        return FacebookGraphAPI(access_token=token, version=self.version)
 
     def get_api_response(self, *args, **kwargs):
-        return self.api.get_object(self.method, *args, **kwargs)
+        delay = self.governor.get_delay(self.api.access_token)
+        if delay:
+            self.logger.warning("Usage of rate limit is high, wait for %d secs. Method %s with params %s" % (
+                delay, self.method, kwargs))
+            time.sleep(delay)
+
+        limit = kwargs.get('limit')
+        if limit:
+            kwargs['limit'] = self.page_size_controller.get_limit(self.method, limit)
+
+        started = time.time()
+        try:
+            if 'batch' in kwargs:
+                return self.api.request(self.api.version + '/', post_args=kwargs)
+            self.api.request_etag = self.etag
+            response = self.api.get_object(self.method, *args, **kwargs)
+        finally:
+            self.governor.update(self.api.access_token, self.api.response_headers)
+
+        if limit:
+            self.page_size_controller.success(self.method, kwargs['limit'], time.time() - started)
+        return response
+
+    def call_batch(self, calls, methods_access_tag=None, **kwargs):
+        """
+        Execute list of calls `(method, params)` via batch requests, maximum `batch_requests_limit` calls per request.
+        Return list of responses in the same order as calls.
+        Error of every call is handled by the same `handle_error_*` methods as error of usual call
+        """
+        responses = []
+        for i in range(0, len(calls), self.batch_requests_limit):
+            calls_batch = calls[i:i + self.batch_requests_limit]
+            batch = [{'method': 'GET', 'relative_url': self.get_batch_relative_url(method, params)}
+                     for method, params in calls_batch]
+            results = self.call('', methods_access_tag, batch=json.dumps(batch), **kwargs)
+            for (method, params), result in zip(calls_batch, results):
+                responses += [self.get_batch_response(result, method, dict(params), methods_access_tag)]
+
+        return responses
+
+    def get_batch_relative_url(self, method, params):
+        if not params:
+            return method
+        params = [(key, unicode(value).encode('utf-8')) for key, value in sorted(params.items()) if value is not None]
+        return '%s?%s' % (method, urlencode(params))
+
+    def get_batch_response(self, result, method, params, methods_access_tag=None):
+        if result is None:
+            # call was not completed in time, according to documentation repeat it separately
+            self.logger.warning("Batch call of method %s with params %s was not completed, repeat it" % (method, params))
+            return self.call(method, methods_access_tag, **params)
+
+        response = json.loads(result['body'])
+        if isinstance(response, dict) and response.get('error'):
+            e = FacebookError(response)
+            # handlers use self.method for repeating call
+            self.method = method
+            params['methods_access_tag'] = methods_access_tag
+            response = self.handle_error_message(e, **params)
+            if response is None:
+                response = self.handle_error_code(e, **params)
+
+        return response
+
+    def handle_error_repeat(self, e, *args, **kwargs):
+        if kwargs.get('limit'):
+            kwargs['limit'] = self.page_size_controller.error(self.method, kwargs['limit'])
+        return super(FacebookApiBase, self).handle_error_repeat(e, *args, **kwargs)
 
     def handle_error_code_1(self, e, *args, **kwargs):
-        if 'limit' in kwargs:
+        if kwargs.get('limit'):
             self.logger.warning("Error 'An unknown error has occurred.', decrease limit. Method %s with params %s, "
                                 "recursion count: %d" % (self.method, kwargs, self.recursion_count))
-            kwargs['limit'] /= 2
+            kwargs['limit'] = self.page_size_controller.error(self.method, kwargs['limit'])
             return self.repeat_call(*args, **kwargs)
         else:
             return self.log_and_raise(e, *args, **kwargs)
 
     def handle_error_code_4(self, e, *args, **kwargs):
-        self.logger.warning("Error 'Application request limit reached', wait for 600 secs. Method %s with params %s, "
-                            "recursion count: %d" % (self.method, kwargs, self.recursion_count))
-        return self.sleep_repeat_call(seconds=600, *args, **kwargs)
+        self.governor.set_limit_reached(self.governor.app_key)
+        self.logger.warning("Error 'Application request limit reached', wait for %d secs. Method %s with params %s, "
+                            "recursion count: %d" % (self.governor.get_delay(None), self.method, kwargs,
+                                                     self.recursion_count))
+        # governor waits before repeated call
+        return self.repeat_call(*args, **kwargs)
 
     def handle_error_code_12(self, e, *args, **kwargs):
         # Error '(#12) notes API is deprecated for versions v2.0 and higher'.
@@ -70,6 +444,7 @@ class FacebookApi(ApiAbstractBase):
         self.logger.warning("Error 'User request limit reached', try access_token of another user. Method %s with "
                             "params %s, recursion count: %d" % (self.method, kwargs, self.recursion_count))
         self.used_access_tokens += [self.api.access_token]
+        self.governor.set_limit_reached(self.api.access_token)
         return self.sleep_repeat_call(*args, **kwargs)
 
     # commented, because lead to endless loop
@@ -87,8 +462,26 @@ class FacebookApi(ApiAbstractBase):
         return self.repeat_call(*args, **kwargs)
 
 
+class FacebookApi(FacebookApiBase):
+    __metaclass__ = Singleton
+
+
 def api_call(*args, **kwargs):
     api = FacebookApi()
     if 'version' in kwargs:
         api.version = kwargs.pop('version')
     return api.call(*args, **kwargs)
+
+
+def api_call_batch(calls, **kwargs):
+    """
+    Execute list of calls `(method, params)` using Graph API batch requests.
+    Usage:
+
+        >>> api_call_batch([('4', {'fields': 'id,name'}), ('5', {})])
+        [{u'id': u'4', u'name': u'Mark Zuckerberg'}, {u'id': u'5', ...}]
+    """
+    api = FacebookApi()
+    if 'version' in kwargs:
+        api.version = kwargs.pop('version')
+    return api.call_batch(calls, **kwargs)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2011-2015 ramusus
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import copy
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+__all__ = ['CachedResponse', 'LocMemResponseCache', 'DjangoResponseCache', 'get_response_cache']
+
+# default time to live of cached responses in seconds, 0 means responses are not cached
+CACHE_TTL = getattr(settings, 'FACEBOOK_API_CACHE_TTL', 0)
+# time in seconds, during which expired response is kept for revalidation using ETag
+CACHE_STALE_TTL = getattr(settings, 'FACEBOOK_API_CACHE_STALE_TTL', 3600)
+# 'locmem' or 'django'
+CACHE_BACKEND = getattr(settings, 'FACEBOOK_API_CACHE_BACKEND', 'locmem')
+CACHE_ALIAS = getattr(settings, 'FACEBOOK_API_CACHE_ALIAS', 'default')
+CACHE_SIZE = getattr(settings, 'FACEBOOK_API_CACHE_SIZE', 1000)
+
+# params, which don't affect content of response
+IGNORED_PARAMS = ['access_token', 'methods_access_tag']
+
+
+class CachedResponse(dict):
+    """
+    Response, returned from cache without changes since the last call
+    """
+    from_cache = True
+
+
+class ResponseCacheBase(object):
+    """
+    Cache of Graph API responses. Entry of cache is dictionary with keys `response`, `etag` and `expires`
+    """
+    prefix = 'facebook_api_response'
+
+    def get_key(self, method, version, params):
+        params = [(key, self.normalize_param(key, value)) for key, value in sorted(params.items())
+                  if key not in IGNORED_PARAMS and value is not None]
+        key = repr((unicode(method).strip('/'), unicode(version), params))
+        return '%s:%s' % (self.prefix, hashlib.md5(key).hexdigest())
+
+    def normalize_param(self, key, value):
+        value = unicode(value)
+        if key == 'fields':
+            value = ','.join(sorted([field.strip() for field in value.split(',')]))
+        return value
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, entry, timeout):
+        raise NotImplementedError()
+
+
+class LocMemResponseCache(ResponseCacheBase):
+    """
+    Cache in memory of process with limited number of responses
+    """
+    def __init__(self, maxsize=CACHE_SIZE):
+        from .utils import LRUCache  # here, because cycling import
+        self.cache = LRUCache(maxsize)
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        if entry['stored_until'] < time.time():
+            self.cache.delete(key)
+            return None
+        # protect stored response from changes of callers
+        return copy.deepcopy(entry)
+
+    def set(self, key, entry, timeout):
+        entry = copy.deepcopy(entry)
+        entry['stored_until'] = time.time() + timeout
+        self.cache.set(key, entry)
+
+
+class DjangoResponseCache(ResponseCacheBase):
+    """
+    Cache in Django cache backend with alias `alias`, it could be shared between processes
+    """
+    def __init__(self, alias=CACHE_ALIAS):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, entry, timeout):
+        self.cache.set(key, entry, timeout)
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            if CACHE_BACKEND == 'locmem':
+                response_cache = LocMemResponseCache()
+            elif CACHE_BACKEND == 'django':
+                response_cache = DjangoResponseCache()
+            else:
+                raise ImproperlyConfigured("Setting FACEBOOK_API_CACHE_BACKEND should be 'locmem' or 'django', "
+                                           "not %s" % CACHE_BACKEND)
+    return response_cache
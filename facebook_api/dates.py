@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2011-2015 ramusus
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+from datetime import datetime
+
+import dateutil.parser
+from dateutil.tz import tzoffset, tzutc
+from django.conf import settings
+
+from .utils import LRUCache
+
+__all__ = ['parse_datetime']
+
+DATETIME_CACHE_SIZE = getattr(settings, 'FACEBOOK_API_DATETIME_CACHE_SIZE', 10000)
+
+datetime_cache = LRUCache(DATETIME_CACHE_SIZE)
+
+UTC = tzutc()
+
+
+def parse_graph_datetime(value):
+    """
+    Parse datetime in the format of Graph API `2015-10-01T10:00:00+0000`. Return None for other formats
+    """
+    if not isinstance(value, basestring) or len(value) != 24 or value[10] != 'T' or value[19] not in '+-':
+        return None
+
+    try:
+        offset = int(value[20:22]) * 3600 + int(value[22:24]) * 60
+        tzinfo = tzoffset(None, offset if value[19] == '+' else -offset) if offset else UTC
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]), tzinfo=tzinfo)
+    except ValueError:
+        return None
+
+
+def parse_datetime(value):
+    """
+    Parse datetime string of API response. Strings of Graph API format are parsed without dateutil,
+    parsed values are cached
+    """
+    result = datetime_cache.get(value)
+    if result is None:
+        result = parse_graph_datetime(value) or dateutil.parser.parse(value)
+        datetime_cache.set(value, result)
+    return result
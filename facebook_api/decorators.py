@@ -23,7 +23,7 @@ try:
 except ImportError:
     from django.db.transaction import commit_on_success as atomic
 
-from .api import FacebookError
+from .api import FacebookError, page_size_controller
 
 
 log = logging.getLogger('facebook_api.models')
@@ -59,27 +59,75 @@ def reduce_data_amount(func):
         ....
     """
     def wrapper(self, *args, **kwargs):
+        # key of page size of method in page size controller
+        key = '%s.%s' % (getattr(self, 'model', self.__class__).__name__, func.__name__)
+        requested_limit = kwargs.get('limit')
+        if requested_limit:
+            kwargs['limit'] = page_size_controller.get_limit(key, requested_limit)
+
         try:
             instances = func(self, *args, **kwargs)
         except FacebookError as e:
             if e.message == "Please reduce the amount of data you're asking for, then retry your request" \
-                and 'limit' in kwargs:
-                    kwargs['limit'] = kwargs['limit'] / 2
-                    log.debug('Reduced amount of asking data in twice. args=%s, kwargs=%s' % (args, kwargs))
+                and kwargs.get('limit'):
+                    kwargs['limit'] = page_size_controller.error(key, kwargs['limit'])
+                    log.debug('Reduced amount of asking data. args=%s, kwargs=%s' % (args, kwargs))
                     return wrapper(self, *args, **kwargs)
             else:
                 raise
 
+        # latency is measured by API around HTTP requests, here are waits for rate limit, retries and parsing
+        if requested_limit:
+            page_size_controller.success(key, kwargs['limit'])
         return instances
 
     return wraps(func)(wrapper)
 
 
+def get_paging_next_arg_value(response, kwargs, paging_next_arg_name):
+    """
+    Return value of the next page argument from response and update kwargs with additional pagination arguments
+    """
+    paging_next = paging_cursors = None
+    if response:
+        try:
+            paging_next = response['paging']['next']
+        except KeyError:
+            pass
+        try:
+            paging_cursors = response['paging']['cursors']
+        except KeyError:
+            pass
+
+    if paging_next_arg_name and paging_next and paging_next_arg_name in paging_next \
+            or paging_next_arg_name and paging_cursors and paging_next_arg_name in paging_cursors:
+        paging_next_arg_value = None
+        # at first look in cursors
+        if paging_cursors:
+            paging_next_arg_value = paging_cursors.get(paging_next_arg_name, None)
+        if paging_next_arg_value is None:
+            # at second look parse from paging_next
+            m = re.findall('%s=([^&]+)' % paging_next_arg_name, paging_next)
+            if len(m):
+                paging_next_arg_value = m[0]
+            # __paging_token=enc_AeylNUQG2Z3DpcZgvUECXW1BHDhsvO8chTp-mQY341mQex3MIce-VnU_PztAiKnskGDcNT61dsycEgphUi9kVy9KYJV2QutwpbPZ0p32OsSQlw
+            m = re.findall('%s=([^&]+)' % '__paging_token', paging_next)
+            if len(m):
+                kwargs['__paging_token'] = m[0]
+        if paging_next_arg_value is None:
+            raise ValueError("Wrong response pagination value: %s, paging_next_arg_name=%s" %
+                             (paging_next, paging_next_arg_name))
+        return paging_next_arg_value
+
+
 @opt_arguments
 def fetch_all(func, return_all=None, always_all=False, paging_next_arg_name=None):
     """
-    Class method decorator for fetching all items. Add parameter `all=False` for decored method.
+    Class method decorator for fetching all items. Add parameters `all=False` and `as_iterator=False`
+    for decored method.
     If `all` is True, method runs as many times as it returns any results.
+    If `as_iterator` is True, method returns iterator over results of every page, results of previous pages
+    are not accumulated and callback `return_all` is not called.
     Decorator receive parameters:
       * callback method `return_all`. It's called with the same parameters
         as decored method after all itmes are fetched.
@@ -90,19 +138,45 @@ def fetch_all(func, return_all=None, always_all=False, paging_next_arg_name=None
         @fetch_all(return_all=lambda self,instance,*a,**k: instance.items.all())
         def fetch_something(self, ..., *kwargs):
         ....
+
+        for instances in self.fetch_something(as_iterator=True):
+        ....
     """
 
+    def iterate_pages(self, args, kwargs):
+        """
+        Iterate over results of pages, kwargs are updated with arguments of the current page
+        """
+        while True:
+            response = None
+            instances = func(self, *args, **kwargs)
+            if len(instances) == 2 and isinstance(instances, tuple):
+                instances, response = instances
+
+            yield instances
+
+            paging_next_arg_value = get_paging_next_arg_value(response, kwargs, paging_next_arg_name)
+            # only if argument is changed
+            if paging_next_arg_value is None or kwargs.get(paging_next_arg_name) == paging_next_arg_value:
+                break
+            kwargs[paging_next_arg_name] = paging_next_arg_value
+
     def wrapper(self, *args, **kwargs):
 
         all = kwargs.pop('all', False) or always_all
-        instances_all = kwargs.pop('instances_all', None)
+        as_iterator = kwargs.pop('as_iterator', False)
 
-        response = None
-        instances = func(self, *args, **kwargs)
-        if len(instances) == 2 and isinstance(instances, tuple):
-            instances, response = instances
+        if as_iterator:
+            return iterate_pages(self, args, kwargs)
 
-        if all:
+        if not all:
+            instances = func(self, *args, **kwargs)
+            if len(instances) == 2 and isinstance(instances, tuple):
+                instances = instances[0]
+            return instances
+
+        instances_all = None
+        for instances in iterate_pages(self, args, kwargs):
             if isinstance(instances, QuerySet):
                 if instances_all is None:
                     instances_all = QuerySet().none()
@@ -115,48 +189,11 @@ def fetch_all(func, return_all=None, always_all=False, paging_next_arg_name=None
                 raise ValueError(
                     "Wrong type of response from func %s. It should be QuerySet or list, not a %s" % (func, type(instances)))
 
-            # resursive pagination
-            paging_next = paging_cursors = None
-            if response:
-                try:
-                    paging_next = response['paging']['next']
-                except KeyError:
-                    pass
-                try:
-                    paging_cursors = response['paging']['cursors']
-                except KeyError:
-                    pass
-
-            if paging_next_arg_name and paging_next and paging_next_arg_name in paging_next \
-                    or paging_next_arg_name and paging_cursors and paging_next_arg_name in paging_cursors:
-                paging_next_arg_value = None
-                # at first look in cursors
-                if paging_cursors:
-                    paging_next_arg_value = paging_cursors.get(paging_next_arg_name, None)
-                if paging_next_arg_value is None:
-                    # at second look parse from paging_next
-                    m = re.findall('%s=([^&]+)' % paging_next_arg_name, paging_next)
-                    if len(m):
-                        paging_next_arg_value = m[0]
-                    # __paging_token=enc_AeylNUQG2Z3DpcZgvUECXW1BHDhsvO8chTp-mQY341mQex3MIce-VnU_PztAiKnskGDcNT61dsycEgphUi9kVy9KYJV2QutwpbPZ0p32OsSQlw
-                    m = re.findall('%s=([^&]+)' % '__paging_token', paging_next)
-                    if len(m):
-                        kwargs['__paging_token'] = m[0]
-                if paging_next_arg_value is None:
-                    raise ValueError("Wrong response pagination value: %s, paging_next_arg_name=%s" %
-                                     (paging_next, paging_next_arg_name))
-                # only if argument is changed
-                if kwargs.get(paging_next_arg_name) != paging_next_arg_value:
-                    kwargs[paging_next_arg_name] = paging_next_arg_value
-                    return wrapper(self, all=all, instances_all=instances_all, *args, **kwargs)
-
-            if return_all:
-                kwargs['instances'] = instances_all
-                return return_all(self, *args, **kwargs)
-            else:
-                return instances_all
+        if return_all:
+            kwargs['instances'] = instances_all
+            return return_all(self, *args, **kwargs)
         else:
-            return instances
+            return instances_all
 
     return wraps(func)(wrapper)
 
@@ -15,7 +15,6 @@ limitations under the License.
 '''
 import logging
 
-from dateutil.parser import parse as datetime_parse
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
@@ -23,9 +22,11 @@ from facebook_users.models import User
 from m2m_history.fields import ManyToManyHistoryField
 
 from .api import api_call
-from .decorators import fetch_all, atomic
+from .dates import parse_datetime
+from .decorators import fetch_all
 from .fields import JSONField
-from .utils import get_or_create_from_small_resource, UnknownResourceType
+from .routers import get_read_database, read_your_writes
+from .utils import get_or_create_from_small_resource, get_or_create_from_small_resources, lock_object
 
 log = logging.getLogger('facebook_api')
 
@@ -51,13 +52,12 @@ class AuthorableModelMixin(models.Model):
     author_id = models.BigIntegerField(null=True, db_index=True)
     author = generic.GenericForeignKey('author_content_type', 'author_id')
 
+    parse_keys_mapping = {'from': 'author_json'}
+
     class Meta:
         abstract = True
 
     def parse(self, response):
-        if 'from' in response:
-            response['author_json'] = response.pop('from')
-
         super(AuthorableModelMixin, self).parse(response)
 
         if self.author is None and self.author_json:
@@ -68,59 +68,106 @@ class ActionableModelMixin(models.Model):
 
     actions_count = models.PositiveIntegerField(null=True, help_text='The number of total actions with this item')
 
+    remote_fields_exclude = ['actions_count']
+
     class Meta:
         abstract = True
 
-    def save(self, *args, **kwargs):
+    def count_actions(self):
         self.actions_count = sum([getattr(self, field, None) or 0
                                   for field in ['likes_count', 'shares_count', 'comments_count']])
-        super(ActionableModelMixin, self).save(*args, **kwargs)
+
+    def _pre_save(self):
+        self.count_actions()
+        super(ActionableModelMixin, self)._pre_save()
+
+    def _update_counters(self):
+        self.count_actions()
+        return super(ActionableModelMixin, self)._update_counters() + ['actions_count']
 
 
 class LikableModelMixin(models.Model):
     likes_users = ManyToManyHistoryField(User, related_name='like_%(class)ss')
     likes_count = models.PositiveIntegerField(null=True, help_text='The number of likes of this item')
 
+    parse_keys_mapping = {'like_count': 'likes_count'}
+    # key `like_count` exists not in all types of resources
+    remote_fields_exclude = ['likes_count']
+    counters_fields = {'likes_count': 'likes.limit(0).summary(true)'}
+
     class Meta:
         abstract = True
 
-    def parse(self, response):
-        if 'like_count' in response:
-            response['likes_count'] = response.pop('like_count')
-
-        super(LikableModelMixin, self).parse(response)
-
     def update_count_and_get_like_users(self, instances, *args, **kwargs):
-        self.likes_users = instances
-        self.likes_count = instances.count()
+        with lock_object(self, 'likes_users'):
+            self.likes_users = instances
+            self.likes_count = instances.count()
 
-        self.save()
+            self.save()
         return instances
 
 
-    # TODO: commented, becouse if many processes fetch_likes, got errors
-    # DatabaseError: deadlock detected
-    # DETAIL:  Process 27235 waits for ShareLock on transaction 3922627359; blocked by process 27037.
-    # @atomic
-    @fetch_all(return_all=update_count_and_get_like_users, paging_next_arg_name='after')
-    def fetch_likes(self, limit=1000, **kwargs):
+    def get_likes_page(self, limit=1000, **kwargs):
         """
-        Retrieve and save all likes of post
+        Retrieve one page of likes of post, return list of pks of users and response
         """
         ids = []
         response = api_call('%s/likes' % self.graph_id, limit=limit, **kwargs)
         if response:
             log.debug('response objects count=%s, limit=%s, after=%s' %
                       (len(response['data']), limit, kwargs.get('after')))
-            for resource in response['data']:
-                try:
-                    user = get_or_create_from_small_resource(resource)
-                    ids += [user.pk]
-                except UnknownResourceType:
-                    continue
+            ids = get_or_create_from_small_resources(response['data']).values()
+
+        return ids, response
 
+    # iterator over pages of pks of users, see sync_likes()
+    fetch_likes_pages = fetch_all(paging_next_arg_name='after')(get_likes_page)
+
+    # without outer transaction: many processes fetching likes got "DatabaseError: deadlock detected",
+    # users are created in transaction of each page and likes are saved at the end under lock of the object
+    @read_your_writes
+    @fetch_all(return_all=update_count_and_get_like_users, paging_next_arg_name='after')
+    def fetch_likes(self, limit=1000, **kwargs):
+        """
+        Retrieve and save all likes of post
+        """
+        ids, response = self.get_likes_page(limit=limit, **kwargs)
         return User.objects.filter(pk__in=ids), response
 
+    @read_your_writes
+    def sync_likes(self, limit=1000, **kwargs):
+        """
+        Retrieve and save likes of post incrementally. Pages of likes are requested from the newest one until the page,
+        all users of which already like post. New likes of every page are added to history of M2M field
+        in a separate short transaction, likes absent in response are removed only after requesting of all pages
+        """
+        ids_current = set(self.likes_users.get_queryset(only_pk=True))
+        ids_fetched = set()
+        ids_added = set()
+        all_pages = True
+        for ids in self.fetch_likes_pages(limit=limit, as_iterator=True, **kwargs):
+            ids_fetched.update(ids)
+            ids_add = sorted(set(ids).difference(ids_current, ids_added))
+            if ids_add:
+                with lock_object(self, 'likes_users'):
+                    self.likes_users.add(*ids_add)
+                ids_added.update(ids_add)
+            if ids and ids_current.issuperset(ids):
+                all_pages = False
+                break
+
+        with lock_object(self, 'likes_users'):
+            if all_pages:
+                ids_remove = sorted(ids_current.difference(ids_fetched))
+                if ids_remove:
+                    self.likes_users.remove(*ids_remove)
+                self.likes_count = len(ids_fetched)
+            else:
+                self.likes_count = len(ids_current) + len(ids_added)
+
+            self.save()
+        return self.likes_users.all()
+
 
 class ReactionableModelMixin(models.Model):
     # without "Like": it may broke something
@@ -128,6 +175,11 @@ class ReactionableModelMixin(models.Model):
 
     reactions_count = models.PositiveIntegerField(null=True, help_text='The number of reactions of this item')
 
+    parse_keys_mapping = {}
+    remote_fields_exclude = ['reactions_count']
+    counters_fields = {'reactions_count': 'reactions.limit(0).summary(true)'}
+    counters_version = 2.6
+
     def update_count_and_get_users_builder(reaction):
 
         def update_count_and_get_reaction_users(self, instances, *args, **kwargs):
@@ -146,67 +198,61 @@ class ReactionableModelMixin(models.Model):
         vars()['{0}s_count'.format(reaction)] = models.PositiveIntegerField(null=True, help_text='The number of {0}s of this item'.format(reaction))
 
         vars()['update_count_and_get_{0}_users'.format(reaction)] = update_count_and_get_users_builder(reaction=reaction)
+        parse_keys_mapping['{0}_count'.format(reaction)] = '{0}s_count'.format(reaction)
+        remote_fields_exclude += ['{0}s_count'.format(reaction)]
+        counters_fields['{0}s_count'.format(reaction)] = \
+            'reactions.type({0}).limit(0).summary(true).as(reactions_{1})'.format(reaction.upper(), reaction)
 
 
     class Meta:
         abstract = True
 
-    def parse(self, response):
-        for reaction in self.reaction_types:
-            if '{0}_count'.format(reaction) in response:
-                response['{0}s_count'.format(reaction)] = response.pop('{0}_count'.format(reaction))
 
-        super(ReactionableModelMixin, self).parse(response)
+    @fetch_all(paging_next_arg_name='after')
+    def fetch_reactions_page(self, limit=1000, **kwargs):
+        """
+        Retrieve one page of reactions of post, return list of resources of users with reaction type
+        """
+        resources = []
+        response = api_call('%s/reactions' % self.graph_id, version=2.6, limit=limit, **kwargs)
+        if response:
+            log.debug('response objects count=%s, limit=%s, after=%s' %
+                      (len(response['data']), limit, kwargs.get('after')))
+            # no 'type' in resource
+            resources = [resource for resource in response['data'] if 'type' in resource]
 
+        return resources, response
 
+    @read_your_writes
     def fetch_reactions(self, reaction=None, limit=1000, **kwargs):
         """
-        Retrieve and save all reactions of post
+        Retrieve and save all reactions of post in one pass over pages of all reactions.
+        Users and counts of all types of reactions are saved at once in a short transaction after the last page
 
         Note: method may return different data structures:
             List:       if reaction is specified
             Dictionary: if reaction is not specified
         """
-        ids = {}
-        types = self.reaction_types + ['LIKE']
-        for id_type in types:
-            ids[id_type.upper()] = []
+        types = [reaction.upper()] if reaction else [id_type.upper() for id_type in self.reaction_types + ['LIKE']]
+        ids = dict([(id_type, set()) for id_type in types])
 
-        response = api_call('%s/reactions' % self.graph_id, version=2.6, limit=limit, **kwargs)
-        if response:
-            log.debug('response objects count=%s, limit=%s, after=%s' %
-                      (len(response['data']), limit, kwargs.get('after')))
-            for resource in response['data']:
-                try:
-                    if (reaction != None) and (reaction.upper() != resource['type']):
-                        continue
-                    try:
-                        user = get_or_create_from_small_resource(resource)
-                        ids[resource['type']] += [user.pk]
-
-                    except UnknownResourceType:
-                        continue
-                # no 'type' in resource
-                except KeyError:
-                    continue
-
-
-        def get_user_ids(self, ids, response):
-            return User.objects.filter(pk__in=ids), response
+        for resources in self.fetch_reactions_page(limit=limit, as_iterator=True, **kwargs):
+            resources = [resource for resource in resources if resource['type'] in ids]
+            pks = get_or_create_from_small_resources(resources)
+            for resource in resources:
+                pk = pks.get(unicode(resource['id']))
+                if pk is not None:
+                    ids[resource['type']].add(pk)
 
         result = {}
-        for id_type in types:
-            if (reaction != None) and (reaction.upper() != id_type.upper()):
-                continue
-
-            count_method = getattr(self, 'update_count_and_get_{0}_users'.format(id_type.lower()))
-            # create count-and-get function wrapped in fetch_all decorator
-            fetch = fetch_all(return_all=count_method, paging_next_arg_name='after')(get_user_ids)
-            result[id_type.upper()] = fetch(self, ids[id_type.upper()], response)
-            # for some reason fetch_all does not call count method
-            count_method(result[id_type.upper()])
-
-        if (reaction != None):
+        with lock_object(self, 'reactions_users'):
+            for id_type in types:
+                result[id_type] = User.objects.filter(pk__in=ids[id_type])
+                setattr(self, '{0}s_users'.format(id_type.lower()), result[id_type])
+                setattr(self, '{0}s_count'.format(id_type.lower()), len(ids[id_type]))
+            self.save()
+
+        if reaction:
             return result[reaction.upper()]
         else:
             return result
@@ -227,6 +273,8 @@ class ShareableModelMixin(models.Model):
     shares_users = ManyToManyHistoryField(User, related_name='shares_%(class)ss')
     shares_count = models.PositiveIntegerField(null=True, help_text='The number of shares of this item')
 
+    remote_fields_exclude = ['shares_count']
+
     class Meta:
         abstract = True
 
@@ -238,57 +286,60 @@ class ShareableModelMixin(models.Model):
             self.save()
         return instances
 
-    @atomic
+    @read_your_writes
     @fetch_all(return_all=update_count_and_get_shares_users, paging_next_arg_name='after')
     def fetch_shares(self, limit=1000, **kwargs):
         """
-        Retrieve and save all shares of post
+        Retrieve and save all shares of post, every page is saved in a separate short transaction
         """
-        from facebook_api.models import MASTER_DATABASE  # here, becouse cycling import
-
         ids = []
 
         response = api_call('%s/sharedposts' % self.graph_id, **kwargs)
         if response:
             posts = [post for post in response['data'] if post.get('from')]
-            timestamps = dict([(int(post['from']['id']), datetime_parse(post['created_time'])) for post in posts])
+            timestamps = dict([(int(post['from']['id']), parse_datetime(post['created_time'])) for post in posts])
             ids_new = timestamps.keys()
-            # becouse we should use local pk, instead of remote, remove it after pk -> graph_id
-            ids_current = map(int, User.objects.filter(pk__in=self.shares_users.get_query_set(
-                only_pk=True).using(MASTER_DATABASE).exclude(time_from=None)).values_list('graph_id', flat=True))
-            ids_add = set(ids_new).difference(set(ids_current))
-            ids_add_pairs = []
-            ids_remove = set(ids_current).difference(set(ids_new))
 
             log.debug('response objects count=%s, limit=%s, after=%s' % (len(posts), limit, kwargs.get('after')))
-            for post in posts:
-                graph_id = int(post['from']['id'])
-                if sorted(post['from'].keys()) == ['id', 'name']:
-                    try:
-                        user = get_or_create_from_small_resource(post['from'])
-                        ids += [user.pk]
-                        # this id in add list and still not in add_pairs (sometimes in response are duplicates)
-                        if graph_id in ids_add and graph_id not in map(lambda i: i[0], ids_add_pairs):
-                            # becouse we should use local pk, instead of remote
-                            ids_add_pairs += [(graph_id, user.pk)]
-                    except UnknownResourceType:
-                        continue
+            posts = [post for post in posts if sorted(post['from'].keys()) == ['id', 'name']]
+            pks = get_or_create_from_small_resources([post['from'] for post in posts])
 
             m2m_model = self.shares_users.through
             # '(album|post)_id'
             field_name = [f.attname for f in m2m_model._meta.local_fields
                           if isinstance(f, models.ForeignKey) and f.name != 'user'][0]
 
-            # remove old shares without time_from
-            self.shares_users.get_query_set_through().filter(time_from=None).delete()
-
-            # in case some ids_add already left
-            self.shares_users.get_query_set_through().filter(
-                **{field_name: self.pk, 'user_id__in': map(lambda i: i[1], ids_add_pairs)}).delete()
-
-            # add new shares with specified `time_from` value
-            get_share_date = lambda id: timestamps[id] if id in timestamps else self.created_time
-            m2m_model.objects.bulk_create([m2m_model(
-                **{field_name: self.pk, 'user_id': pk, 'time_from': get_share_date(graph_id)}) for graph_id, pk in ids_add_pairs])
+            with lock_object(self, 'shares_users'):
+                # becouse we should use local pk, instead of remote, remove it after pk -> graph_id
+                database = get_read_database()
+                ids_current = map(int, User.objects.using(database).filter(pk__in=self.shares_users.get_query_set(
+                    only_pk=True).using(database).exclude(time_from=None)).values_list('graph_id', flat=True))
+                ids_add = set(ids_new).difference(set(ids_current))
+                ids_add_pairs = []
+
+                for post in posts:
+                    graph_id = int(post['from']['id'])
+                    pk = pks.get(unicode(post['from']['id']))
+                    if pk is None:
+                        continue
+                    ids += [pk]
+                    # this id in add list and still not in add_pairs (sometimes in response are duplicates)
+                    if graph_id in ids_add and graph_id not in map(lambda i: i[0], ids_add_pairs):
+                        # becouse we should use local pk, instead of remote
+                        ids_add_pairs += [(graph_id, pk)]
+                ids_add_pairs.sort(key=lambda i: i[1])
+
+                # remove old shares without time_from
+                self.shares_users.get_query_set_through().filter(time_from=None).delete()
+
+                # in case some ids_add already left
+                self.shares_users.get_query_set_through().filter(
+                    **{field_name: self.pk, 'user_id__in': map(lambda i: i[1], ids_add_pairs)}).delete()
+
+                # add new shares with specified `time_from` value
+                get_share_date = lambda id: timestamps[id] if id in timestamps else self.created_time
+                m2m_model.objects.bulk_create([m2m_model(**{field_name: self.pk, 'user_id': pk,
+                                                            'time_from': get_share_date(graph_id)})
+                                               for graph_id, pk in ids_add_pairs])
 
         return User.objects.filter(pk__in=ids), response
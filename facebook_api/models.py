@@ -13,23 +13,29 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import chain
+from urlparse import parse_qsl, urlparse
+import calendar
 import time
 import logging
+import threading
 
 import re
-import dateutil.parser
 from django.conf import settings
 from django.db import models
 from django.db.models.query import QuerySet
-from django.db.models.fields import FieldDoesNotExist
 from django.utils.translation import ugettext as _
 from django.utils import timezone
 
 from . import fields
-from .api import api_call
+from .api import api_call, FacebookApi, FacebookError
+from .dates import parse_datetime
 from .decorators import atomic, reduce_data_amount
-from .signals import facebook_api_post_fetch
+from .routers import MASTER_DATABASE, get_read_database, get_write_database, read_your_writes
+from .scheduler import AsyncResponse, FacebookApiScheduler, async_api_call, async_iterate_pages
+from .signals import facebook_api_post_fetch, facebook_api_post_fetch_many
 
 try:
     from django.db.models.related import RelatedObject as ForeignObjectRel
@@ -39,17 +45,155 @@ except ImportError:
 
 log = logging.getLogger('facebook_api.models')
 
-MASTER_DATABASE = getattr(settings, 'FACEBOOK_API_MASTER_DATABASE', 'default')
+# use the newest date of fetched timeline items as default value of `since`, see TimelineCheckpoint
+TIMELINE_CHECKPOINT = getattr(settings, 'FACEBOOK_API_TIMELINE_CHECKPOINT', True)
+# seconds before the newest date of timeline, items of which are fetched again for catching late changes
+TIMELINE_CHECKPOINT_OVERLAP = getattr(settings, 'FACEBOOK_API_TIMELINE_CHECKPOINT_OVERLAP', 3600)
 
 
 class FacebookContentError(Exception):
     pass
 
 
+def hashable_value(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+# request only fields of models, which don't declare `remote_fields`, see FacebookGraphModel.get_remote_fields()
+REMOTE_FIELDS_AUTO = getattr(settings, 'FACEBOOK_API_REMOTE_FIELDS_AUTO', False)
+
+# cache of parse plans of models, see FacebookGraphModel.get_parse_plan()
+PARSE_PLANS = {}
+# cache of lists of remote fields of models, see FacebookGraphModel.get_remote_fields()
+REMOTE_FIELDS = {}
+
+
+# registry of related instances, parsed from the current response, see get_related_instance()
+related_registry = threading.local()
+
+
+def get_related_instance(model, resource):
+    """
+    Return instance of model, parsed from nested resource. Resources with the same remote pk inside one response
+    are parsed to the same instance, so it's saved only once
+    """
+    registry = getattr(related_registry, 'instances', None)
+    remote_pk = resource.get(getattr(model, 'remote_pk_field', 'id'))
+    if registry is None or remote_pk is None:
+        instance = model()
+        instance.parse(resource)
+        return instance
+
+    key = (model, unicode(remote_pk))
+    try:
+        instance, parsed_resource = registry[key]
+    except KeyError:
+        instance, parsed_resource = model(), None
+    if resource != parsed_resource:
+        instance.parse(resource)
+        registry[key] = (instance, resource)
+    return instance
+
+
+def get_expansion_key(expansion):
+    """
+    Return key of resource with value of field expansion, for example `reactions_love` for
+    `reactions.type(LOVE).limit(0).summary(true).as(reactions_love)`
+    """
+    alias = re.findall(r'\.as\((\w+)\)', expansion)
+    return alias[0] if alias else expansion.split('.')[0]
+
+
+def get_counter_parser(name):
+    """
+    Return function for parsing total count of field expansion with summary to the count field with `name`
+    """
+    def parse_value(instance, value):
+        try:
+            setattr(instance, name, value['summary']['total_count'])
+        except (KeyError, TypeError):
+            log.debug('Summary is absent in value %s of count field %s' % (value, name))
+    return parse_value
+
+
+def get_field_parser(name, field):
+    """
+    Return function for parsing value of API response and setting it to the field with `name` of instance
+    """
+    if isinstance(field, ForeignObjectRel):
+        def parse_value(instance, value):
+            if value:
+                for item in value:
+                    rel_instance = field.model()
+                    rel_instance.parse(dict(item))
+                    instance._external_links_post_save += [(field.field.name, rel_instance)]
+            else:
+                setattr(instance, name, value)
+
+    elif isinstance(field, models.DateTimeField):
+        def parse_value(instance, value):
+            setattr(instance, name, parse_datetime(value) if value else value)
+
+    elif isinstance(field, models.IntegerField):
+        def parse_value(instance, value):
+            if value:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    pass
+            setattr(instance, name, value)
+
+    elif isinstance(field, (models.OneToOneField, models.ForeignKey)):
+        def parse_value(instance, value):
+            if value:
+                rel_instance = get_related_instance(field.rel.to, dict(value))
+                value = rel_instance
+                instance._foreignkeys_post_save += [(name, rel_instance)]
+            setattr(instance, name, value)
+
+    elif isinstance(field, (fields.CommaSeparatedCharField, models.CommaSeparatedIntegerField)):
+        def parse_value(instance, value):
+            if isinstance(value, list):
+                value = ','.join([unicode(v) for v in value])
+            elif value and isinstance(value, (str, unicode)):
+                value = value.strip()
+            setattr(instance, name, value)
+
+    elif isinstance(field, (models.CharField, models.TextField)):
+        def parse_value(instance, value):
+            if value and isinstance(value, (str, unicode)):
+                value = value.strip()
+            setattr(instance, name, value)
+
+    else:
+        def parse_value(instance, value):
+            setattr(instance, name, value)
+
+    return parse_value
+
+
 class FacebookGraphManager(models.Manager):
     """
     Facebook Graph Manager for RESTful CRUD operations
     """
+    # maximum number of ids in one multi-object request, limited by Facebook
+    ids_chunk_size = 50
+    # maximum number of values in one `IN` lookup of bulk saving queries
+    bulk_chunk_size = 500
+    # save lists of instances in bulk: True, False or None - only if model doesn't override method save()
+    bulk_save = None
+    # send facebook_api_post_fetch signal for every instance saved in bulk
+    post_fetch_instance_signals = False
+    # time to live of cached responses of resource in seconds, None means default value of API
+    cache_ttl = None
+    # return stored instances instead of parsing response, returned from cache without changes
+    skip_cached_parsing = True
+    # request only fields of model, even if model doesn't declare `remote_fields`
+    remote_fields_auto = REMOTE_FIELDS_AUTO
 
     def __init__(self, remote_pk=None, resource_path='%s', *args, **kwargs):
         if '%s' not in resource_path:
@@ -90,8 +234,15 @@ class FacebookGraphManager(models.Manager):
         for field_name in self.remote_pk:
             remote_pk_dict[field_name] = getattr(instance, field_name)
 
+        database = get_read_database()
         try:
-            old_instance = self.model.objects.using(MASTER_DATABASE).get(**remote_pk_dict)
+            try:
+                old_instance = self.model.objects.using(database).get(**remote_pk_dict)
+            except self.model.DoesNotExist:
+                if database == MASTER_DATABASE:
+                    raise
+                # replica could be behind master
+                old_instance = self.model.objects.using(MASTER_DATABASE).get(**remote_pk_dict)
             instance._substitute(old_instance)
             instance.save()
         except self.model.DoesNotExist:
@@ -105,9 +256,196 @@ class FacebookGraphManager(models.Manager):
         instance = self.parse_response_dict(response, extra_fields)
         return self.get_or_create_from_instance(instance)
 
-    def get_or_create_from_instances_list(self, instances):
-        return self.model.objects.filter(pk__in=set([self.get_or_create_from_instance(instance).pk for instance in instances]))
+    def get_or_create_from_instances_list(self, instances, instance_signals=None):
+        """
+        Save list of instances and return queryset of them.
+        Instances are saved in bulk if model supports it, see `bulk_get_or_create_from_instances`
+        """
+        if self.is_bulk_save():
+            instances = self.bulk_get_or_create_from_instances(instances, instance_signals=instance_signals)
+        else:
+            instances = [self.get_or_create_from_instance(instance) for instance in instances]
+
+        return self.model.objects.using(MASTER_DATABASE).filter(pk__in=set([instance.pk for instance in instances]))
+
+    def is_bulk_save(self):
+        """
+        Return True if instances of model could be saved in bulk: model has one remote pk field, it's not
+        inherited from concrete model and method save() is not overridden, if it's not defined by `bulk_save`
+        """
+        if len(self.remote_pk) != 1 or self.model._meta.parents:
+            return False
+        if self.bulk_save is not None:
+            return self.bulk_save
+        for klass in self.model.__mro__:
+            if klass is FacebookGraphModel:
+                break
+            if 'save' in klass.__dict__:
+                return False
+        return True
 
+    @atomic
+    def bulk_get_or_create_from_instances(self, instances, instance_signals=None):
+        """
+        Save list of instances with a few queries: select existing rows by remote pk, insert new rows
+        using bulk_create and update changed fields of existing rows, grouping rows with equal changes in one query.
+        Model.save() is not called and pre_save/post_save signals are not sent, Model._pre_save() and
+        Model._post_save() are called instead. Signal facebook_api_post_fetch_many is sent once for all instances,
+        facebook_api_post_fetch for every instance only if `instance_signals` or `post_fetch_instance_signals` is True
+        """
+        if instance_signals is None:
+            instance_signals = self.post_fetch_instance_signals
+
+        remote_pk_field = self.model._meta.get_field(self.remote_pk[0])
+
+        self._bulk_save_foreignkeys(instances)
+
+        # the same object could be in list several times, the last one wins as with saving one by one
+        instances_saved = []
+        instances_dict = OrderedDict()
+        for instance in instances:
+            remote_pk = remote_pk_field.to_python(getattr(instance, remote_pk_field.attname))
+            if remote_pk is None:
+                # nothing to look up by, save it as a new object
+                instance.save()
+                instances_saved += [instance]
+            else:
+                instance._pre_save()
+                instances_dict[remote_pk] = instance
+
+        # existing rows are selected from replica, absent ones are checked again in master, which replica could be behind
+        database = get_read_database()
+        old_instances = self._bulk_get_old_instances(list(instances_dict.keys()), remote_pk_field, database)
+        remote_pks = [remote_pk for remote_pk in instances_dict.keys() if remote_pk not in old_instances]
+        if remote_pks and database != MASTER_DATABASE:
+            old_instances.update(self._bulk_get_old_instances(remote_pks, remote_pk_field, MASTER_DATABASE))
+
+        instances_new = []
+        instances_old = []
+        for remote_pk, instance in instances_dict.items():
+            if remote_pk in old_instances:
+                instance._substitute(old_instances[remote_pk])
+                instances_old += [instance]
+            else:
+                instances_new += [instance]
+
+        self._bulk_create_instances(instances_new, remote_pk_field)
+        self._bulk_update_instances(instances_old, old_instances, remote_pk_field)
+
+        for instance in instances_new + instances_old:
+            instance._state.adding = False
+            instance._state.db = MASTER_DATABASE
+        self._bulk_post_save(instances_new + instances_old)
+
+        instances_new = instances_saved + instances_new
+        instances = instances_new + instances_old
+
+        facebook_api_post_fetch_many.send(sender=self.model, instances=instances, created_instances=instances_new)
+        if instance_signals:
+            created_ids = set([id(instance) for instance in instances_new])
+            for instance in instances:
+                facebook_api_post_fetch.send(sender=instance.__class__, instance=instance,
+                                             created=(id(instance) in created_ids))
+
+        log.debug('Fetch and save %d objects %s in bulk, %d of them created' % (
+            len(instances), self.model, len(instances_new)))
+        return instances
+
+    def _bulk_get_old_instances(self, remote_pks, remote_pk_field, database):
+        old_instances = {}
+        for i in range(0, len(remote_pks), self.bulk_chunk_size):
+            lookup = {'%s__in' % remote_pk_field.name: remote_pks[i:i + self.bulk_chunk_size]}
+            for old_instance in self.model.objects.using(database).filter(**lookup):
+                old_instances[getattr(old_instance, remote_pk_field.attname)] = old_instance
+        return old_instances
+
+    def _bulk_save_foreignkeys(self, instances):
+        """
+        Save not saved related instances of foreignkeys of all instances with one bulk upsert per related model
+        """
+        related = OrderedDict()
+        for instance in instances:
+            for field, rel_instance in instance._foreignkeys_post_save:
+                manager = getattr(rel_instance.__class__, 'remote', None)
+                if rel_instance._state.adding and isinstance(manager, FacebookGraphManager) \
+                        and manager.is_bulk_save():
+                    related.setdefault(manager, OrderedDict())[id(rel_instance)] = rel_instance
+
+        for manager, rel_instances in related.items():
+            manager.bulk_get_or_create_from_instances(rel_instances.values())
+
+    def _bulk_post_save(self, instances):
+        """
+        Save related instances of reverse relations of all instances with one bulk upsert per related model,
+        after that call Model._post_save() of every instance for the rest of post save stages
+        """
+        rel_instances = OrderedDict()
+        for instance in instances:
+            for field, rel_instance in instance._external_links_post_save:
+                # set foreignkey to the main instance
+                setattr(rel_instance, field, instance)
+                rel_instances.setdefault(rel_instance.__class__, []).append(rel_instance)
+            instance._external_links_post_save = []
+
+        for model, model_instances in rel_instances.items():
+            model.remote.get_or_create_from_instances_list(model_instances)
+
+        for instance in instances:
+            instance._post_save()
+
+    def _bulk_create_instances(self, instances, remote_pk_field):
+        if not instances:
+            return
+
+        # rows are inserted and updated in order of remote pks and pks by all processes to avoid deadlocks
+        instances = sorted(instances, key=lambda instance: getattr(instance, remote_pk_field.attname))
+        self.model.objects.using(get_write_database()).bulk_create(instances)
+
+        # pk values of created rows are not returned by bulk_create, select them by remote pk
+        if not remote_pk_field.primary_key:
+            instances_dict = dict([(remote_pk_field.to_python(getattr(instance, remote_pk_field.attname)), instance)
+                                   for instance in instances])
+            remote_pks = list(instances_dict.keys())
+            for i in range(0, len(remote_pks), self.bulk_chunk_size):
+                lookup = {'%s__in' % remote_pk_field.name: remote_pks[i:i + self.bulk_chunk_size]}
+                for remote_pk, pk in self.model.objects.using(MASTER_DATABASE).filter(**lookup).values_list(
+                        remote_pk_field.attname, 'pk'):
+                    instances_dict[remote_pk].pk = pk
+
+    def _bulk_update_instances(self, instances, old_instances, remote_pk_field):
+        fields = [field for field in self.model._meta.concrete_fields if not field.primary_key]
+
+        # group pks of rows by equal set of changed values
+        changes_pks = OrderedDict()
+        changes_values = {}
+        for instance in instances:
+            old_instance = old_instances[remote_pk_field.to_python(getattr(instance, remote_pk_field.attname))]
+            changes = []
+            for field in fields:
+                value = field.pre_save(instance, False)
+                old_value = getattr(old_instance, field.attname)
+                try:
+                    changed = value != old_value
+                except TypeError:
+                    # comparing of offset-naive and offset-aware datetimes
+                    changed = True
+                if changed:
+                    changes += [(field.name, value)]
+
+            if not changes:
+                continue
+
+            key = tuple([(name, hashable_value(value)) for name, value in changes])
+            changes_pks.setdefault(key, []).append(instance.pk)
+            changes_values[key] = dict(changes)
+
+        for key, pks in sorted(changes_pks.items(), key=lambda item: min(item[1])):
+            pks = sorted(pks)
+            for i in range(0, len(pks), self.bulk_chunk_size):
+                self.model.objects.using(get_write_database()).filter(
+                    pk__in=pks[i:i + self.bulk_chunk_size]).update(**changes_values[key])
+
+    @read_your_writes
     @atomic
     def fetch(self, *args, **kwargs):
         """
@@ -121,8 +459,148 @@ class FacebookGraphManager(models.Manager):
         else:
             return self.get_or_create_from_instance(result)
 
+    @read_your_writes
+    @atomic
+    def fetch_many(self, ids, **kwargs):
+        """
+        Retrieve objects by list of graph ids and save them to local DB
+        """
+        return self.get_or_create_from_instances_list(self.get_many(ids, **kwargs))
+
+    @read_your_writes
+    @atomic
+    def refresh_counters(self, instances, fields=None, **kwargs):
+        """
+        Update count fields of instances by total counts of edges without fetching of edges and changing of M2M fields.
+        Counts of up to `ids_chunk_size` objects are requested at once using field expansions like
+        `likes.limit(0).summary(true)`, declared in `counters_fields` of model and mixins.
+        Argument `fields` limits list of updated count fields
+        """
+        counters = self.model.get_counters_fields()
+        if fields is not None:
+            counters = dict([(field, counters[field]) for field in fields])
+        if not counters:
+            return instances
+
+        if self.model.counters_version:
+            kwargs.setdefault('version', self.model.counters_version)
+
+        instances_dict = dict([(unicode(instance.graph_id), instance) for instance in instances])
+        ids = instances_dict.keys()
+        for i in range(0, len(ids), self.ids_chunk_size):
+            ids_chunk = ids[i:i + self.ids_chunk_size]
+            self.response = self.call('', ids=','.join(ids_chunk), fields=','.join(['id'] + counters.values()),
+                                      **kwargs)
+            for graph_id in ids_chunk:
+                instance = instances_dict[graph_id]
+                resource = self.response.get(graph_id)
+                if not resource:
+                    log.debug('Object with graph id %s is absent in response for model %s' % (graph_id, self.model))
+                    continue
+
+                names = []
+                for name, expansion in counters.items():
+                    key = get_expansion_key(expansion)
+                    try:
+                        setattr(instance, name, resource[key]['summary']['total_count'])
+                    except (KeyError, TypeError):
+                        log.debug('Key "%s" with summary is absent in resource %s' % (key, resource))
+                        continue
+                    names += [name]
+
+                names += instance._update_counters()
+                if instance.pk and names:
+                    self.model.objects.using(get_write_database()).filter(pk=instance.pk).update(
+                        **dict([(name, getattr(instance, name)) for name in set(names)]))
+
+        return instances
+
     def api_call(self, *args, **kwargs):
-        return api_call(self.resource_path % args[0], **kwargs)
+        return self.call(self.resource_path % args[0], **kwargs)
+
+    def get_call_kwargs(self, kwargs):
+        """
+        Return arguments of call with default values of manager: time to live of cache and list of fields of model.
+        Argument `fields` could be specified for the call, `fields=None` means all fields of object
+        """
+        kwargs = dict(kwargs)
+        if self.cache_ttl is not None:
+            kwargs.setdefault('cache_ttl', self.cache_ttl)
+        if (self.remote_fields_auto or self.model.remote_fields is not None) and 'fields' not in kwargs:
+            version = kwargs.get('version', FacebookApi().version)
+            kwargs['fields'] = ','.join(self.model.get_remote_fields(version)) or None
+        return kwargs
+
+    def call(self, method, **kwargs):
+        """
+        Call API method with default arguments of manager.
+        If Graph API doesn't support any of fields of model, repeat call without list of fields
+        """
+        call_kwargs = self.get_call_kwargs(kwargs)
+        try:
+            return api_call(method, **call_kwargs)
+        except FacebookError as e:
+            if not self.is_remote_fields_error(e, kwargs, call_kwargs):
+                raise
+            return api_call(method, **self.get_call_kwargs_without_fields(e, call_kwargs))
+
+    def is_remote_fields_error(self, error, kwargs, call_kwargs):
+        """
+        Return True, if `error` is caused by unsupported fields of model, which were not specified by caller
+        """
+        if not isinstance(error, FacebookError) or error.code not in [12, 100] or 'fields' in kwargs \
+                or not call_kwargs.get('fields'):
+            return False
+        # errors '(#100) Tried accessing nonexisting field' and '(#12) field is deprecated for versions v2.0
+        # and higher', but not '(#100) Unsupported get request' of absent object
+        message = unicode(error.message).lower()
+        return 'nonexisting field' in message or 'deprecated' in message and 'field' in message
+
+    def get_call_kwargs_without_fields(self, error, call_kwargs):
+        log.warning("Error '%s' while requesting fields %s of model %s, request all fields instead" % (
+            error, call_kwargs['fields'], self.model))
+        call_kwargs = dict(call_kwargs)
+        del call_kwargs['fields']
+        return call_kwargs
+
+    def get_many(self, ids, **kwargs):
+        """
+        Retrieve objects by list of graph ids from remote server, `ids_chunk_size` objects per request
+        """
+        extra_fields = kwargs.pop('extra_fields', {})
+        extra_fields['fetched'] = timezone.now()
+
+        ids = [unicode(graph_id) for graph_id in ids]
+        instances = []
+        for i in range(0, len(ids), self.ids_chunk_size):
+            ids_chunk = ids[i:i + self.ids_chunk_size]
+            self.response = self.get_many_chunk(ids_chunk, **kwargs)
+            for graph_id in ids_chunk:
+                if graph_id not in self.response:
+                    log.debug('Object with graph id %s is absent in response for model %s' % (graph_id, self.model))
+                    continue
+                instances += [self.parse_response_dict(self.response[graph_id], extra_fields)]
+
+        return instances
+
+    def get_many_chunk(self, ids, **kwargs):
+        """
+        Return response for chunk of graph ids. If any of objects doesn't exist, Graph API fails the whole request
+        with error #100, so chunk is split in halves until missing objects are found and skipped
+        """
+        try:
+            return self.call('', ids=','.join(ids), **kwargs)
+        except FacebookError as e:
+            if e.code != 100:
+                raise
+            if len(ids) == 1:
+                log.debug("Object with graph id %s is absent for model %s: '%s'" % (ids[0], self.model, e))
+                return {}
+            response = {}
+            middle = len(ids) // 2
+            for ids_part in [ids[:middle], ids[middle:]]:
+                response.update(self.get_many_chunk(ids_part, **kwargs))
+            return response
 
     def get(self, *args, **kwargs):
         """
@@ -135,8 +613,77 @@ class FacebookGraphManager(models.Manager):
         # if bunch of posts -> return data attribute, if one -> just return response
         response = self.response['data'] if 'data' in self.response else self.response
 
+        if self.skip_cached_parsing and getattr(self.response, 'from_cache', False):
+            result = self.get_stored_instances(response)
+            if result is not None:
+                return result
+
         return self.parse_response(response, extra_fields)
 
+    def get_stored_instances(self, response):
+        """
+        Return stored instances of resources of response, or None if any of them is absent in local DB
+        """
+        if self.remote_pk != ('graph_id',):
+            return None
+
+        resources = response if isinstance(response, (list, tuple)) else [response]
+        try:
+            graph_ids = set([unicode(resource['id']) for resource in resources])
+        except (KeyError, TypeError):
+            return None
+
+        queryset = self.model.objects.using(get_read_database()).filter(graph_id__in=graph_ids)
+        if queryset.count() != len(graph_ids):
+            return None
+        return queryset if isinstance(response, (list, tuple)) else queryset.get()
+
+    def get_async(self, *args, **kwargs):
+        """
+        Retrieve objects from remote server without blocking, the call is executed by the default scheduler.
+        Return object with method `get`, which waits for response and parses it
+        """
+        extra_fields = kwargs.pop('extra_fields', {})
+        extra_fields['fetched'] = timezone.now()
+        method = self.resource_path % args[0]
+        call_kwargs = self.get_call_kwargs(kwargs)
+        result = async_api_call(method, **call_kwargs)
+
+        def parse_response(response):
+            response = response['data'] if 'data' in response else response
+            return self.parse_response(response, extra_fields)
+
+        def repeat_call(error, timeout):
+            if not self.is_remote_fields_error(error, kwargs, call_kwargs):
+                raise error
+            return async_api_call(method, **self.get_call_kwargs_without_fields(error, call_kwargs)).get(timeout)
+
+        return AsyncResponse(result, parse_response, repeat_call)
+
+    def get_pages_async(self, *args, **kwargs):
+        """
+        Iterate over lists of objects of pages of resource, the next page is requested by the default scheduler,
+        while the current one is parsed. Argument `paging_next_arg_name` is the same, as in `fetch_all` decorator
+        """
+        extra_fields = kwargs.pop('extra_fields', {})
+        extra_fields['fetched'] = timezone.now()
+        paging_next_arg_name = kwargs.pop('paging_next_arg_name', 'after')
+        method = self.resource_path % args[0]
+        call_kwargs = self.get_call_kwargs(kwargs)
+
+        pages = async_iterate_pages(method, paging_next_arg_name, **call_kwargs)
+        try:
+            response = next(pages)
+        except FacebookError as e:
+            if not self.is_remote_fields_error(e, kwargs, call_kwargs):
+                raise
+            call_kwargs = self.get_call_kwargs_without_fields(e, call_kwargs)
+            pages = async_iterate_pages(method, paging_next_arg_name, **call_kwargs)
+            response = next(pages)
+
+        for response in chain([response], pages):
+            yield self.parse_response(response['data'] if 'data' in response else response, extra_fields)
+
     def parse_response(self, response, extra_fields=None):
         if isinstance(response, (list, tuple)):
             return self.parse_response_list(response, extra_fields)
@@ -157,17 +704,26 @@ class FacebookGraphManager(models.Manager):
 
     def parse_response_list(self, response_list, extra_fields=None):
 
+        # related resources are deduplicated inside the outermost list
+        registry_owner = getattr(related_registry, 'instances', None) is None
+        if registry_owner:
+            related_registry.instances = {}
+
         instances = []
-        for resource in response_list:
+        try:
+            for resource in response_list:
 
-            try:
-                resource = dict(resource)
-            except (TypeError, ValueError), e:
-                log.error("Resource %s is not dictionary" % resource)
-                raise e
+                try:
+                    resource = dict(resource)
+                except (TypeError, ValueError), e:
+                    log.error("Resource %s is not dictionary" % resource)
+                    raise e
 
-            instance = self.parse_response_dict(resource, extra_fields)
-            instances += [instance]
+                instance = self.parse_response_dict(resource, extra_fields)
+                instances += [instance]
+        finally:
+            if registry_owner:
+                related_registry.instances = None
 
         return instances
 
@@ -178,10 +734,124 @@ class FacebookGraphTimelineManager(FacebookGraphManager):
     """
     timeline_cut_fieldname = 'created_time'
     timeline_force_ordering = True
+    # parsed instances are filtered by timeline dates
+    skip_cached_parsing = False
+    timeline_checkpoint = TIMELINE_CHECKPOINT
+    timeline_checkpoint_overlap = TIMELINE_CHECKPOINT_OVERLAP
+    # arguments of request of not the first page of timeline, `until` is not here, because it's argument of caller too
+    timeline_paging_arg_names = ['after', '__paging_token']
+    # checkpoint moved by the last get(), it's saved only after items are saved
+    pending_checkpoint = None
 
     def get_timeline_date(self, instance):
         return getattr(instance, self.timeline_cut_fieldname, datetime(1970, 1, 1).replace(tzinfo=timezone.utc))
 
+    def get_timeline_checkpoint(self, owner_id):
+        checkpoint, created = TimelineCheckpoint.objects.using(MASTER_DATABASE).get_or_create(
+            model='%s.%s' % (self.model._meta.app_label, self.model._meta.model_name),
+            owner_id=unicode(owner_id), resource_path=self.resource_path)
+        return checkpoint
+
+    def get_timeline_slices(self, owner_id, since, until, slice_size):
+        """
+        Return list of slices of timeline between `since` and `until` from the newest one, create absent slices.
+        Slices are cut forward from `since`, so their boundaries are the same in every run. If `until` is None,
+        slices are cut until the current time and the last one is not truncated
+        """
+        lookup = {
+            'model': '%s.%s' % (self.model._meta.app_label, self.model._meta.model_name),
+            'owner_id': unicode(owner_id),
+            'resource_path': self.resource_path,
+        }
+        end = until or timezone.now()
+        slices = []
+        while since < end:
+            lookup.update(since=since, until=min(since + slice_size, until) if until else since + slice_size)
+            slices.insert(0, TimelineSlice.objects.using(MASTER_DATABASE).get_or_create(**lookup)[0])
+            since = lookup['until']
+        return slices
+
+    def backfill(self, owner_id, since, until=None, slice_size=timedelta(days=30), workers=None, **kwargs):
+        """
+        Fetch and save items of timeline between `since` and `until`. Range is split on slices of `slice_size`,
+        pages of slices are requested concurrently by FacebookApiScheduler, responses are parsed and saved
+        in the current thread. Progress of every slice is saved in TimelineSlice after every page, so interrupted
+        backfill is continued from the next page of every not completed slice. Return number of saved items
+        """
+        kwargs = self.get_call_kwargs(kwargs)
+        method = self.resource_path % owner_id
+        slices = [timeline_slice for timeline_slice in self.get_timeline_slices(owner_id, since, until, slice_size)
+                  if not timeline_slice.completed]
+
+        def submit(timeline_slice):
+            params = dict(kwargs, since=calendar.timegm(timeline_slice.since.utctimetuple()),
+                          until=calendar.timegm(timeline_slice.until.utctimetuple()))
+            params.update(timeline_slice.next_params or {})
+            return scheduler.submit(method, **params)
+
+        count = 0
+        with FacebookApiScheduler(workers=workers) as scheduler:
+            results = dict([(submit(timeline_slice), timeline_slice) for timeline_slice in slices])
+            while results:
+                ready = [result for result in results if result.ready()]
+                if not ready:
+                    results.keys()[0].wait(0.1)
+                    continue
+
+                for result in ready:
+                    timeline_slice = results.pop(result)
+                    response = result.get()
+                    count += self.save_timeline_slice_page(timeline_slice, response)
+                    if not timeline_slice.completed:
+                        results[submit(timeline_slice)] = timeline_slice
+
+        return count
+
+    @read_your_writes
+    @atomic
+    def save_timeline_slice_page(self, timeline_slice, response):
+        """
+        Save items of page of timeline slice and arguments of request of the next page, return number of saved items
+        """
+        instances = []
+        for instance in self.parse_response_list(response.get('data', []), {'fetched': timezone.now()}):
+            timeline_date = self.get_timeline_date(instance)
+            if not isinstance(timeline_date, datetime) or timeline_slice.since <= timeline_date <= timeline_slice.until:
+                instances += [instance]
+        if instances:
+            self.get_or_create_from_instances_list(instances)
+
+        try:
+            next_params = dict(parse_qsl(urlparse(response['paging']['next']).query))
+            next_params.pop('access_token', None)
+        except KeyError:
+            next_params = None
+
+        # the next page is the same or all items of page are out of slice
+        if not next_params or next_params == timeline_slice.next_params or not response.get('data') \
+                or not instances:
+            timeline_slice.completed = True
+            next_params = None
+
+        timeline_slice.next_params = next_params
+        timeline_slice.save()
+        return len(instances)
+
+    @atomic
+    def get_or_create_from_instances_list(self, instances, *args, **kwargs):
+        result = super(FacebookGraphTimelineManager, self).get_or_create_from_instances_list(instances, *args, **kwargs)
+        self.save_timeline_checkpoint()
+        return result
+
+    def save_timeline_checkpoint(self):
+        """
+        Save checkpoint moved by the last get(). Called after items are saved, callers saving items themselves
+        should call it explicitly
+        """
+        if self.pending_checkpoint:
+            self.pending_checkpoint.save()
+            self.pending_checkpoint = None
+
     @atomic
     @reduce_data_amount
     def get(self, *args, **kwargs):
@@ -189,10 +859,24 @@ class FacebookGraphTimelineManager(FacebookGraphManager):
         Retrieve objects and return result list with respect to parameters:
          * 'since' - excluding all items after.
          * 'until' - excluding all items before.
+         * 'checkpoint' - if neither `since` nor `until` are specified, use the newest date of previously fetched
+           items minus `timeline_checkpoint_overlap` seconds as `since`. All pages of one pass use the same value,
+           the newest date is moved forward only after the last page of pass. Checkpoint is saved only after items
+           are saved, see save_timeline_checkpoint()
         """
         since = kwargs.pop('since', None)
         until = kwargs.pop('until', None)
 
+        checkpoint = self.pending_checkpoint = None
+        if kwargs.pop('checkpoint', self.timeline_checkpoint) and since is None and until is None and args:
+            checkpoint = self.get_timeline_checkpoint(args[0])
+            if not any([kwargs.get(name) for name in self.timeline_paging_arg_names]):
+                # the first page of a new pass, items of not finished previous pass are fetched again
+                checkpoint.since = checkpoint.date - timedelta(seconds=self.timeline_checkpoint_overlap) \
+                    if checkpoint.date else None
+                checkpoint.pass_date = None
+            since = checkpoint.since
+
         # convert str or int -> datetime for comparing
         if until and not isinstance(until, datetime):
             until = datetime.utcfromtimestamp(int(until)).replace(tzinfo=timezone.utc)
@@ -218,27 +902,42 @@ class FacebookGraphTimelineManager(FacebookGraphManager):
         result = super(FacebookGraphTimelineManager, self).get(*args, **kwargs)
 
         if isinstance(result, list):
+            items = [(self.get_timeline_date(instance), instance) for instance in result]
 
-            if self.timeline_force_ordering and result:
-                result.sort(key=self.get_timeline_date, reverse=True)
+            # sort only if items are not ordered from the newest to the oldest yet
+            if self.timeline_force_ordering and any([items[i][0] < items[i + 1][0] for i in range(len(items) - 1)]):
+                items.sort(key=lambda item: item[0], reverse=True)
 
             instances = []
-            for instance in result:
-
-                timeline_date = self.get_timeline_date(instance)
+            for timeline_date, instance in items:
 
                 if timeline_date and isinstance(timeline_date, datetime):
 
                     if since and since > timeline_date:
+                        # items of the next pages are older, remove paging for stopping of fetching them
+                        if isinstance(self.response, dict) and self.response.pop('paging', None):
+                            log.debug('Timeline crossed since %s, stop paging of %s' % (since, self.model))
                         break
 
                     if until and until < timeline_date:
                         continue
 
                 instances += [instance]
-            return instances
         else:
-            return result
+            instances = result
+
+        if checkpoint:
+            dates = [self.get_timeline_date(instance) for instance in instances] if isinstance(instances, list) else []
+            dates = [date for date in dates + [checkpoint.pass_date] if isinstance(date, datetime)]
+            checkpoint.pass_date = max(dates) if dates else None
+            # there is no next page or paging was stopped, because since was crossed
+            if not isinstance(self.response, dict) or not (self.response.get('paging') or {}).get('next'):
+                dates = [date for date in [checkpoint.date, checkpoint.pass_date] if date]
+                checkpoint.date = max(dates) if dates else None
+                checkpoint.pass_date = None
+            self.pending_checkpoint = checkpoint
+
+        return instances
 
 
 class FacebookGraphModel(models.Model):
@@ -246,6 +945,10 @@ class FacebookGraphModel(models.Model):
         abstract = True
 
     remote_pk_field = 'id'
+    # list of keys of resource for `fields` argument of request, None means list is built from fields of model
+    remote_fields = None
+    # version of API for requesting counters, see FacebookGraphManager.refresh_counters()
+    counters_version = None
 
     # fetched = models.DateTimeField(u'Обновлено', null=True, blank=True)
 
@@ -273,62 +976,122 @@ class FacebookGraphModel(models.Model):
         """
         self.id = old_instance.id
 
-    def parse(self, response):
+    @classmethod
+    def get_parse_plan(cls):
         """
-        Parse API response and define fields with values
+        Return dictionary {key of API response: function for parsing value of this key}.
+        Plan is built once for every model, when it's parsed first time and all related models are loaded
         """
-        for key, value in response.items():
-
-            if key == self.remote_pk_field:
-                key = 'graph_id'
+        try:
+            return PARSE_PLANS[cls]
+        except KeyError:
+            pass
+
+        plan = {}
+        for name in cls._meta.get_all_field_names():
+            field = cls._meta.get_field_by_name(name)[0]
+            plan[name] = get_field_parser(name, field)
+
+        # remote pk of resource is saved to graph_id field
+        if 'graph_id' in plan:
+            plan[cls.remote_pk_field] = plan['graph_id']
+        else:
+            plan.pop(cls.remote_pk_field, None)
 
-            try:
-                field, model, direct, m2m = self._meta.get_field_by_name(key)
-            except FieldDoesNotExist:
-                log.debug('Field with name "%s" doesn\'t exist in the model %s' % (key, type(self)))
-                continue
+        # keys of resource with names different from names of fields, defined in mixins
+        for klass in reversed(cls.__mro__):
+            for key, name in klass.__dict__.get('parse_keys_mapping', {}).items():
+                if name in plan:
+                    plan[key] = plan[name]
 
-            if isinstance(field, ForeignObjectRel) and value:
-                for item in value:
-                    rel_instance = field.model()
-                    rel_instance.parse(dict(item))
-                    self._external_links_post_save += [(field.field.name, rel_instance)]
-            else:
-                if isinstance(field, models.DateTimeField) and value:
-                    value = dateutil.parser.parse(value)  # .replace(tzinfo=None)
+        # field expansions with summaries of count fields, see get_remote_fields()
+        for name, expansion in cls.get_counters_fields().items():
+            key = get_expansion_key(expansion)
+            if name in plan and key not in plan:
+                plan[key] = get_counter_parser(name)
 
-                elif isinstance(field, (models.IntegerField)) and value:
-                    try:
-                        value = int(value)
-                    except:
-                        pass
+        PARSE_PLANS[cls] = plan
+        return plan
 
-                elif isinstance(field, (models.OneToOneField, models.ForeignKey)) and value:
-                    rel_instance = field.rel.to()
-                    rel_instance.parse(dict(value))
-                    value = rel_instance
-                    if isinstance(field, models.ForeignKey):
-                        self._foreignkeys_post_save += [(key, rel_instance)]
+    @classmethod
+    def get_counters_fields(cls):
+        """
+        Return dictionary {count field: field expansion with summary}, merged from `counters_fields` of model and mixins
+        """
+        counters = {}
+        for klass in reversed(cls.__mro__):
+            counters.update(klass.__dict__.get('counters_fields', {}))
+        return counters
 
-                elif isinstance(field, (fields.CommaSeparatedCharField, models.CommaSeparatedIntegerField)) and \
-                        isinstance(value, list):
-                    value = ','.join([unicode(v) for v in value])
+    @classmethod
+    def get_remote_fields(cls, version=None):
+        """
+        Return list of keys of resource, which are parsed to concrete fields and foreignkeys of model.
+        Fields, listed in `remote_fields_exclude` of model and mixins, are not requested. Count fields are requested
+        by field expansions with summary from `counters_fields`, if `version` of API is not less than
+        `counters_version` of the class, where they are declared
+        """
+        if cls.remote_fields is not None:
+            return list(cls.remote_fields)
+        try:
+            return REMOTE_FIELDS[(cls, version)]
+        except KeyError:
+            pass
+
+        exclude = set(['fetched', 'graph_id'])
+        for klass in cls.__mro__:
+            exclude.update(klass.__dict__.get('remote_fields_exclude', []))
+        # parts of generic foreignkeys
+        for field in cls._meta.virtual_fields:
+            exclude.update([getattr(field, 'ct_field', None), getattr(field, 'fk_field', None)])
+
+        names = set([field.name for field in cls._meta.concrete_fields
+                     if field.name not in exclude and not isinstance(field, models.AutoField)])
+
+        # keys of resource with names different from names of fields, defined in mixins
+        keys = set()
+        for klass in cls.__mro__:
+            for key, name in klass.__dict__.get('parse_keys_mapping', {}).items():
+                if name in names:
+                    keys.add(key)
+                    exclude.add(name)
+        keys.update(names.difference(exclude))
+
+        if 'graph_id' in cls._meta.get_all_field_names():
+            keys.add(cls.remote_pk_field)
+
+        expansions = {}
+        for klass in reversed(cls.__mro__):
+            counters_version = klass.__dict__.get('counters_version')
+            for name, expansion in klass.__dict__.get('counters_fields', {}).items():
+                if counters_version and (version is None or float(version) < float(counters_version)):
+                    expansions.pop(name, None)
+                else:
+                    expansions[name] = expansion
+        keys.update(expansions.values())
+
+        REMOTE_FIELDS[(cls, version)] = sorted(keys)
+        return REMOTE_FIELDS[(cls, version)]
 
-                elif isinstance(field, (models.CharField, models.TextField)) and value:
-                    if isinstance(value, (str, unicode)):
-                        value = value.strip()
+    def parse(self, response):
+        """
+        Parse API response and define fields with values
+        """
+        plan = self.get_parse_plan()
+        for key, value in response.items():
+            try:
+                parse_value = plan[key]
+            except KeyError:
+                log.debug('Field with name "%s" doesn\'t exist in the model %s' % (key, type(self)))
+                continue
 
-                setattr(self, key, value)
+            parse_value(self, value)
 
     def save(self, *args, **kwargs):
         """
         Save all related instances until or after current instance
         """
-        for field, instance in self._foreignkeys_post_save:
-            instance = instance.__class__.remote.get_or_create_from_instance(instance)
-            instance.save()
-            setattr(self, field, instance)
-        self._foreignkeys_post_save = []
+        self._pre_save()
 
         try:
             super(FacebookGraphModel, self).save(*args, **kwargs)
@@ -336,17 +1099,57 @@ class FacebookGraphModel(models.Model):
             import sys
             raise type(e), type(e)(e.message + ' while saving %s' % self.__dict__), sys.exc_info()[2]
 
+        self._post_save()
+
+    def _pre_save(self):
+        """
+        Prepare instance for saving: save related foreignkeys instances.
+        Called from save() and from Manager.get_or_create_from_instances_list(), where instances are saved in bulk.
+        Can be extended in child models and mixins
+        """
+        for field, instance in self._foreignkeys_post_save:
+            # related instance could be already saved with another instance of the same response
+            if instance._state.adding:
+                instance = instance.__class__.remote.get_or_create_from_instance(instance)
+                instance.save()
+            setattr(self, field, instance)
+        self._foreignkeys_post_save = []
+
+    def _update_counters(self):
+        """
+        Update fields, calculated from count fields, after FacebookGraphManager.refresh_counters().
+        Return list of names of updated fields. Can be extended in child models and mixins
+        """
+        return []
+
+    def _post_save(self):
+        """
+        Save related instances, which require saved current instance
+        """
+        rel_instances = OrderedDict()
         for field, instance in self._external_links_post_save:
             # set foreignkey to the main instance
             setattr(instance, field, self)
-            instance.__class__.remote.get_or_create_from_instance(instance)
+            rel_instances.setdefault(instance.__class__, []).append(instance)
         self._external_links_post_save = []
 
-        # process self._external_links_to_add
+        for model, instances in rel_instances.items():
+            model.remote.get_or_create_from_instances_list(instances)
+
+        # process self._external_links_to_add, add and remove only changed links
         for field, instances in self._external_links_to_add.items():
-            getattr(self, field).all().delete()
-            for instance in instances:
-                getattr(self, field).add(instance)
+            manager = getattr(self, field)
+            pks_current = set(manager.values_list('pk', flat=True))
+            pks_remove = pks_current.difference(set([instance.pk for instance in instances]))
+            if pks_remove:
+                if hasattr(manager, 'through'):
+                    manager.remove(*manager.filter(pk__in=pks_remove))
+                else:
+                    # objects of reverse foreign key are deleted, not unlinked
+                    manager.filter(pk__in=pks_remove).delete()
+            instances_add = [instance for instance in instances if instance.pk not in pks_current]
+            if instances_add:
+                manager.add(*instances_add)
         self._external_links_to_add = {}
 
 
@@ -386,3 +1189,39 @@ class FacebookGraphIntPKModel(FacebookGraphPKModelMixin, FacebookGraphModel):
 
     class Meta:
         abstract = True
+
+
+class TimelineCheckpoint(models.Model):
+    """
+    The newest date of timeline items of model, fetched from resource of owner, see FacebookGraphTimelineManager
+    """
+    model = models.CharField(max_length=100)
+    owner_id = models.CharField(max_length=100)
+    resource_path = models.CharField(max_length=255)
+
+    date = models.DateTimeField(null=True, help_text='The newest date of fetched items')
+    pass_date = models.DateTimeField(null=True, help_text='The newest date of items of not finished pass over pages')
+    since = models.DateTimeField(null=True, help_text='Value of argument `since` of the last pass over pages')
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('model', 'owner_id', 'resource_path')
+
+
+class TimelineSlice(models.Model):
+    """
+    Slice of timeline of model between dates `since` and `until`, fetched from resource of owner
+    by FacebookGraphTimelineManager.backfill()
+    """
+    model = models.CharField(max_length=100)
+    owner_id = models.CharField(max_length=100)
+    resource_path = models.CharField(max_length=255)
+
+    since = models.DateTimeField()
+    until = models.DateTimeField()
+    next_params = fields.JSONField(null=True, help_text='Arguments of request of the next page')
+    completed = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('model', 'owner_id', 'resource_path', 'since', 'until')
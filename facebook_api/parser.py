@@ -15,7 +15,8 @@ limitations under the License.
 '''
 from bs4 import BeautifulSoup
 from oauth_tokens.providers.facebook import FacebookAccessToken
-import requests
+
+from .session import get_session
 
 
 class FacebookParseError(Exception):
@@ -50,6 +51,6 @@ class FacebookParser(object):
                 self.auth_access = FacebookAccessToken().auth_request
             response = self.auth_access.authorized_request(*args, **kwargs)
         else:
-            response = getattr(requests, kwargs.pop('method', 'get'))(*args, **kwargs)
+            response = getattr(get_session(), kwargs.pop('method', 'get'))(*args, **kwargs)
 
         self.content = response.content
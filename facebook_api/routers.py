@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2011-2015 ramusus
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.utils.functional import wraps
+
+__all__ = ['FacebookApiRouter', 'get_read_database', 'get_write_database', 'read_your_writes']
+
+MASTER_DATABASE = getattr(settings, 'FACEBOOK_API_MASTER_DATABASE', 'default')
+# aliases of read-only replicas of master database, reads are spread between them randomly
+REPLICA_DATABASES = list(getattr(settings, 'FACEBOOK_API_REPLICA_DATABASES', []))
+# seconds after the last write, during which reads of the thread go to master, while replicas catch up
+REPLICA_PIN_TIMEOUT = getattr(settings, 'FACEBOOK_API_REPLICA_PIN_TIMEOUT', 5)
+
+state = threading.local()
+
+
+def get_write_database():
+    """
+    Return alias of master database and pin reads of the current thread to it
+    """
+    state.written_at = time.time()
+    if getattr(state, 'depth', 0):
+        state.written = True
+    return MASTER_DATABASE
+
+
+def get_read_database():
+    """
+    Return alias of replica database, or master if there are no replicas or the current thread wrote to master
+    inside `read_your_writes` scope or less than REPLICA_PIN_TIMEOUT seconds ago
+    """
+    if not REPLICA_DATABASES or getattr(state, 'written', False) \
+            or time.time() - getattr(state, 'written_at', 0) < REPLICA_PIN_TIMEOUT:
+        return MASTER_DATABASE
+    return random.choice(REPLICA_DATABASES)
+
+
+class ReadYourWrites(object):
+    """
+    Decorator and context manager of scope, inside which all reads of the thread go to master
+    after the first write. Scopes could be nested, the pin is kept until the end of the outer one
+    """
+    def __enter__(self):
+        state.depth = getattr(state, 'depth', 0) + 1
+
+    def __exit__(self, *args):
+        state.depth -= 1
+        if not state.depth and getattr(state, 'written', False):
+            state.written = False
+            state.written_at = time.time()
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wraps(func)(wrapper)
+
+read_your_writes = ReadYourWrites()
+
+
+class FacebookApiRouter(object):
+    """
+    Database router, which sends writes to FACEBOOK_API_MASTER_DATABASE and reads to FACEBOOK_API_REPLICA_DATABASES.
+    Usage in settings:
+
+        DATABASE_ROUTERS = ['facebook_api.routers.FacebookApiRouter']
+    """
+    def db_for_read(self, model, **hints):
+        return get_read_database()
+
+    def db_for_write(self, model, **hints):
+        return get_write_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [MASTER_DATABASE] + REPLICA_DATABASES
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, *args, **kwargs):
+        if db in REPLICA_DATABASES:
+            return False
+        return None
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2011-2015 ramusus
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from social_api.api import NoActiveTokens
+
+from .api import FacebookApi, FacebookApiBase
+from .decorators import get_paging_next_arg_value
+
+__all__ = ['FacebookApiScheduler', 'AsyncResponse', 'async_api_call', 'async_iterate_pages']
+
+TOKEN_CONCURRENCY = getattr(settings, 'FACEBOOK_API_TOKEN_CONCURRENCY', 2)
+
+
+class FacebookApiScheduler(object):
+    """
+    Scheduler of independent API calls, executes them concurrently in pool of threads.
+    Calls are spread between all available access tokens, not more than `token_concurrency` calls
+    with the same token at the same time.
+    Usage:
+
+        >>> scheduler = FacebookApiScheduler()
+        >>> result = scheduler.submit('4', fields='id,name')
+        >>> result.get()
+        {u'id': u'4', u'name': u'Mark Zuckerberg'}
+        >>> scheduler.map([('4', {}), ('5', {})])
+        [{u'id': u'4', ...}, {u'id': u'5', ...}]
+        >>> scheduler.close()
+    """
+    def __init__(self, workers=None, token_concurrency=None, tokens=None):
+        self.token_concurrency = token_concurrency or TOKEN_CONCURRENCY
+        self.tokens = tokens or FacebookApi().get_tokens()
+        if not self.tokens:
+            raise NoActiveTokens("There is no active tokens for provider facebook")
+
+        self.tokens_calls = dict([(token, 0) for token in self.tokens])
+        self.tokens_condition = threading.Condition()
+        self.pool = ThreadPool(workers or len(self.tokens) * self.token_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def acquire_token(self):
+        """
+        Return the least used token, wait until any token is free if all of them are used by maximum number of calls
+        """
+        with self.tokens_condition:
+            while True:
+                token = min(self.tokens, key=lambda token: self.tokens_calls[token])
+                if self.tokens_calls[token] < self.token_concurrency:
+                    self.tokens_calls[token] += 1
+                    return token
+                self.tokens_condition.wait()
+
+    def release_token(self, token):
+        with self.tokens_condition:
+            self.tokens_calls[token] -= 1
+            self.tokens_condition.notify()
+
+    def execute(self, method, args, kwargs):
+        token = self.acquire_token()
+        try:
+            # instance of FacebookApi is singleton and it's state can not be shared between threads
+            api = FacebookApiBase()
+            api.token = token
+            if 'version' in kwargs:
+                api.version = kwargs.pop('version')
+            return api.call(method, *args, **kwargs)
+        finally:
+            self.release_token(token)
+            # token storages could open connection in this thread
+            connection.close()
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Schedule call of API method, return AsyncResult object with methods `get`, `wait`, `ready`
+        """
+        return self.pool.apply_async(self.execute, (method, args, kwargs))
+
+    def map(self, calls):
+        """
+        Execute list of calls `(method, params)` concurrently, return list of responses in the same order
+        """
+        return [result.get() for result in [self.submit(method, **params) for method, params in calls]]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class AsyncResponse(object):
+    """
+    Result of asynchronous call, which is processed by `callback` in the thread, that gets it.
+    If call is failed, `errback(error, timeout)` could return response instead of raising the error
+    """
+    def __init__(self, result, callback, errback=None):
+        self.result = result
+        self.callback = callback
+        self.errback = errback
+
+    def ready(self):
+        return self.result.ready()
+
+    def wait(self, timeout=None):
+        self.result.wait(timeout)
+
+    def get(self, timeout=None):
+        try:
+            response = self.result.get(timeout)
+        except Exception as e:
+            if self.errback is None:
+                raise
+            response = self.errback(e, timeout)
+        return self.callback(response)
+
+
+default_scheduler = None
+default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    global default_scheduler
+    with default_scheduler_lock:
+        if default_scheduler is None:
+            default_scheduler = FacebookApiScheduler()
+    return default_scheduler
+
+
+def async_api_call(*args, **kwargs):
+    """
+    Schedule call of API method in the default scheduler without blocking, return AsyncResult object
+    Usage:
+
+        >>> results = [async_api_call(graph_id) for graph_id in ['4', '5']]
+        >>> [result.get() for result in results]
+        [{u'id': u'4', ...}, {u'id': u'5', ...}]
+    """
+    return get_default_scheduler().submit(*args, **kwargs)
+
+
+def async_iterate_pages(method, paging_next_arg_name='after', scheduler=None, **kwargs):
+    """
+    Iterate over responses of pages of API method, like methods decorated by `fetch_all`. The next page is requested
+    in the scheduler before the current one is returned, so it's fetched while the current page is processed
+    Usage:
+
+        >>> for response in async_iterate_pages('4/likes', limit=1000):
+        ...     save_likes(response['data'])
+    """
+    scheduler = scheduler or get_default_scheduler()
+    result = scheduler.submit(method, **kwargs)
+    while result is not None:
+        response = result.get()
+        paging_next_arg_value = get_paging_next_arg_value(response, kwargs, paging_next_arg_name)
+        result = None
+        # only if argument is changed
+        if paging_next_arg_value is not None and kwargs.get(paging_next_arg_name) != paging_next_arg_value:
+            kwargs[paging_next_arg_name] = paging_next_arg_value
+            result = scheduler.submit(method, **kwargs)
+        yield response
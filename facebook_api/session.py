@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2011-2015 ramusus
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+__all__ = ['get_session', 'get_pool_stats', 'reset_session']
+
+POOL_CONNECTIONS = getattr(settings, 'FACEBOOK_API_POOL_CONNECTIONS', 10)
+POOL_MAXSIZE = getattr(settings, 'FACEBOOK_API_POOL_MAXSIZE', 20)
+MAX_RETRIES = getattr(settings, 'FACEBOOK_API_MAX_RETRIES', 3)
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_adapter():
+    """
+    Adapter with pool of keep-alive connections per host. Requests are repeated on errors of connection
+    and on connections, reset before reading response. POST requests are not repeated, because they aren't idempotent
+    """
+    retries = Retry(total=MAX_RETRIES, connect=MAX_RETRIES, read=MAX_RETRIES, backoff_factor=0.1)
+    return HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retries)
+
+
+def get_session():
+    """
+    Return session shared by all Graph API instances and parsers of the process
+    """
+    global session
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            adapter = get_adapter()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+    return session
+
+
+def reset_session():
+    global session
+    with session_lock:
+        if session is not None:
+            session.close()
+        session = None
+
+
+def get_pool_stats():
+    """
+    Return list of statistics of connection pools of the shared session:
+    host, number of opened connections, number of sent requests and number of idle connections in pool
+    """
+    stats = []
+    if session is None:
+        return stats
+
+    adapters = set(session.adapters.values())
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats += [{
+                'scheme': pool.scheme,
+                'host': pool.host,
+                'port': pool.port,
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': pool.pool.qsize() if pool.pool else 0,
+                'maxsize': adapter._pool_maxsize,
+            }]
+    return stats
@@ -17,3 +17,5 @@ from django.dispatch import Signal
 
 #facebook_api_pre_fetch = Signal(providing_args=["instance"])#, "raw", "using", "fetch_fields"])
 facebook_api_post_fetch = Signal(providing_args=["instance", "created"])#, "raw", "using", "fetch_fields"])
+# sent once per list of instances saved by Manager.get_or_create_from_instances_list()
+facebook_api_post_fetch_many = Signal(providing_args=["instances", "created_instances"])
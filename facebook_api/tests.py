@@ -13,13 +13,93 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
+import json
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import mock
+from django.db import connection, models
+from django.db.models.signals import m2m_changed, post_delete
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from facebook_users.models import User
 from social_api.testcase import SocialApiTestCase
 
-from .api import api_call, FacebookApi
+from .cache import CachedResponse, LocMemResponseCache
+from .api import api_call, api_call_batch, FacebookApi, FacebookError, FacebookGraphAPI, FacebookPageSizeController, \
+    FacebookRateLimitGovernor
+from .dates import parse_datetime
+from .decorators import fetch_all, reduce_data_amount
+from .mixins import AuthorableModelMixin, LikableModelMixin, ReactionableModelMixin, ShareableModelMixin
+from .models import FacebookGraphIDModel, FacebookGraphManager, FacebookGraphTimelineManager, TimelineCheckpoint, \
+    TimelineSlice, get_expansion_key
+from .routers import FacebookApiRouter, get_read_database, get_write_database, read_your_writes
+from . import routers
+from .scheduler import FacebookApiScheduler
+from .session import get_pool_stats, get_session, reset_session
+from .signals import facebook_api_post_fetch, facebook_api_post_fetch_many
+from .utils import get_or_create_from_small_resource, get_or_create_from_small_resources, small_resources_cache, \
+    get_lock_key, lock_object, LockTimeout, UnknownResourceType
 
 TOKEN = 'CAAGPdaGocPIBANyHk4GO3HJYhNalf78scXf5CprODAIYELOjW7DBkYG6uV5hip71fEv19jZBrQdN1nUhsrcvghxKtuxEIMgPqr4XUQMnvx8SApZBU3C6ccyknaNunFqgMbZB0VQFaYukP6NEGDfvcZBbRk6DdxnCZCO7z20KkBd3ZB5Rusgskxx0S2ARZCfN8KZAzgAq3F3KSgZDZD'  # noqa
 
 
+class GraphObject(FacebookGraphIDModel):
+    name = models.CharField(max_length=100)
+    likes_count = models.PositiveIntegerField(null=True)
+    created_time = models.DateTimeField(null=True)
+
+    remote = FacebookGraphManager()
+    timeline = FacebookGraphTimelineManager(resource_path='%s/objects')
+
+
+class GraphChildObject(FacebookGraphIDModel):
+    name = models.CharField(max_length=100)
+    parent = models.ForeignKey(GraphObject, null=True, related_name='+')
+
+    remote = FacebookGraphManager()
+
+
+class GraphSavedObject(FacebookGraphIDModel):
+    name = models.CharField(max_length=100)
+
+    remote = FacebookGraphManager()
+
+    def save(self, *args, **kwargs):
+        self.name = self.name.upper()
+        super(GraphSavedObject, self).save(*args, **kwargs)
+
+
+class GraphComment(AuthorableModelMixin, LikableModelMixin, FacebookGraphIDModel):
+    message = models.TextField()
+
+    remote = FacebookGraphManager()
+
+
+class GraphPost(LikableModelMixin, ReactionableModelMixin, ShareableModelMixin, FacebookGraphIDModel):
+    message = models.TextField()
+    created_time = models.DateTimeField(null=True)
+
+    remote = FacebookGraphManager()
+
+
+class GraphAlbum(FacebookGraphIDModel):
+    name = models.CharField(max_length=100)
+    objects_tagged = models.ManyToManyField(GraphObject, related_name='+')
+
+    remote = FacebookGraphManager()
+
+
+class GraphPhoto(FacebookGraphIDModel):
+    album = models.ForeignKey(GraphAlbum, related_name='photos')
+
+    remote = FacebookGraphManager()
+
+
 class FacebookApiTestCase(SocialApiTestCase):
     provider = 'facebook'
     token = TOKEN
@@ -41,3 +121,927 @@ class FacebookApiTest(FacebookApiTestCase):
     #     # strange error sometimes appear
     #     with self.assertRaises(Exception):
     #         api_call('135161613191462/posts', **{'limit': 250, 'since': 1416258000})
+
+    def test_rate_limit_governor(self):
+        governor = FacebookRateLimitGovernor(threshold=75, max_delay=600)
+        governor.update('token1', {'x-app-usage': '{"call_count": 50, "total_time": 10, "total_cputime": 5}',
+                                   'x-page-usage': '{"call_count": 85, "total_time": 10, "total_cputime": 5}'})
+        self.assertEqual(governor.get_delay('token2'), 0)
+        # 40% of the rest above threshold is used, call costs 1%, which is emptied in 36 secs
+        self.assertAlmostEqual(governor.get_delay('token1'), 0.4 * 36, delta=0.1)
+        self.assertEqual(governor.get_best_token(['token1', 'token2']), 'token2')
+
+        # delay grows gradually with usage
+        governor.set_usage('token2', 95)
+        self.assertAlmostEqual(governor.get_delay('token2'), 0.8 * 36, delta=0.1)
+
+        # cost of call is measured from reported usages
+        for i in range(20):
+            governor.set_usage('token3', 80)
+        self.assertLess(governor.get_cost('token3'), 0.1)
+        self.assertLess(governor.get_delay('token3'), 1)
+
+        # repeated errors of reached limit increase delays exponentially up to maximum
+        governor.set_limit_reached(governor.app_key)
+        self.assertAlmostEqual(governor.get_delay('token2'), 2 * 36, delta=0.1)
+        governor.set_limit_reached(governor.app_key)
+        self.assertAlmostEqual(governor.get_delay('token2'), 4 * 36, delta=0.1)
+        for i in range(3):
+            governor.set_limit_reached(governor.app_key)
+        self.assertEqual(governor.get_delay('token2'), 600)
+
+    def test_rate_limit_governor_headers(self):
+        response = mock.Mock(headers={'content-type': 'application/json', 'x-app-usage': '{"call_count": 30}'})
+        response.json.return_value = {'id': '4'}
+        api = FacebookApi()
+        with mock.patch.object(api, 'governor', FacebookRateLimitGovernor()), \
+                mock.patch('requests.Session.request', return_value=response):
+            self.assertEqual(api_call('4'), {'id': '4'})
+            self.assertAlmostEqual(api.governor.get_usage(api.governor.app_key), 30, delta=1)
+
+    def test_page_size_controller(self):
+        controller = FacebookPageSizeController(increase=100, max_latency=10, max_error_rate=0.2, window=10)
+        self.assertEqual(controller.get_key('v2.3/10153_2345/likes'), '{id}/likes')
+
+        controller.error('1/likes', 1000)
+        self.assertEqual(controller.get_limit('2/likes', 1000), 500)
+        self.assertEqual(controller.get_limit('2/comments', 1000), 1000)
+        controller.error('1/likes', 500)
+        self.assertEqual(controller.get_limit('2/likes', 1000), 250)
+
+        # size is not increased, until errors are less than 20% of the last 10 responses
+        for i in range(7):
+            controller.success('1/likes', 250, latency=1)
+        self.assertEqual(controller.get_limit('2/likes', 1000), 250)
+        controller.success('1/likes', 250, latency=1)
+        self.assertEqual(controller.get_limit('2/likes', 1000), 350)
+
+        # single slow response doesn't decrease size, frequent ones do
+        controller.success('1/likes', 350, latency=11)
+        self.assertEqual(controller.get_limit('2/likes', 1000), 350)
+        controller.success('1/likes', 350, latency=11)
+        controller.success('1/likes', 350, latency=11)
+        self.assertEqual(controller.get_limit('2/likes', 1000), 175)
+        self.assertAlmostEqual(controller.get_error_rate('2/likes'), 0.3)
+
+        controller = FacebookPageSizeController(increase=100)
+        error = FacebookError({'error': {'code': 1, 'message': 'An unknown error has occurred.'}})
+        with mock.patch.object(FacebookApi(), 'page_size_controller', controller), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=[error, {'data': []}, {'data': []}]) as get_object:
+            api_call('1/likes', limit=1000)
+            self.assertEqual(get_object.call_args[1]['limit'], 500)
+            api_call('1/likes', limit=1000)
+            self.assertEqual(get_object.call_args[1]['limit'], 500)
+
+    def test_reduce_data_amount_latency(self):
+        class Fetcher(object):
+            @reduce_data_amount
+            def fetch_likes(self, limit):
+                return []
+
+        # latency of the whole method with waits for rate limit and parsing is not measured
+        with mock.patch('facebook_api.decorators.page_size_controller') as controller:
+            controller.get_limit.return_value = 100
+            Fetcher().fetch_likes(limit=1000)
+        controller.success.assert_called_once_with('Fetcher.fetch_likes', 100)
+
+    def test_shared_session(self):
+        reset_session()
+        self.assertEqual(get_pool_stats(), [])
+
+        session = get_session()
+        self.assertIs(get_session(), session)
+        adapter = session.get_adapter('https://graph.facebook.com/')
+        self.assertEqual(adapter.max_retries.connect, 3)
+
+        adapter.poolmanager.connection_from_url('https://graph.facebook.com/')
+        stats = get_pool_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['host'], 'graph.facebook.com')
+        self.assertEqual(stats[0]['connections'], 0)
+
+
+class ResponseCacheTest(FacebookApiTestCase):
+
+    def get_response(self, status_code=200, etag='"abc"'):
+        response = mock.Mock(status_code=status_code, headers={'content-type': 'application/json', 'etag': etag})
+        response.json.return_value = {'id': '4', 'name': 'Object 4'}
+        return response
+
+    def test_ttl_and_etag_revalidation(self):
+        cache = LocMemResponseCache()
+        with mock.patch('facebook_api.cache.response_cache', cache), \
+                mock.patch('requests.Session.request', return_value=self.get_response()) as request:
+            response = api_call('4', fields='name, id', cache_ttl=60)
+            self.assertFalse(getattr(response, 'from_cache', False))
+
+            response = api_call('4', fields='id,name', cache_ttl=60)
+            self.assertIsInstance(response, CachedResponse)
+            self.assertEqual(response['name'], 'Object 4')
+            self.assertEqual(request.call_count, 1)
+
+            # expire response and check conditional request
+            key = cache.get_key('4', FacebookApi().version, {'fields': 'id,name'})
+            cache.cache.get(key)['expires'] = 0
+            request.return_value = self.get_response(status_code=304)
+            response = api_call('4', fields='id,name', cache_ttl=60)
+            self.assertIsInstance(response, CachedResponse)
+            self.assertEqual(response['name'], 'Object 4')
+            self.assertEqual(request.call_count, 2)
+            self.assertEqual(request.call_args[1]['headers'], {'If-None-Match': '"abc"'})
+
+    def test_manager_skips_parsing_of_cached_response(self):
+        with mock.patch('facebook_api.cache.response_cache', LocMemResponseCache()), \
+                mock.patch('requests.Session.request', return_value=self.get_response()):
+            GraphObject.remote.fetch('4', cache_ttl=60)
+            with mock.patch.object(GraphObject, 'parse') as parse:
+                instance = GraphObject.remote.fetch('4', cache_ttl=60)
+
+        self.assertFalse(parse.called)
+        self.assertEqual(instance.name, 'Object 4')
+        self.assertEqual(GraphObject.objects.count(), 1)
+
+
+class FacebookApiBatchTest(FacebookApiTestCase):
+
+    def batch_response(self, path, args=None, post_args=None, **kwargs):
+        return [{'code': 200, 'body': json.dumps({'id': call['relative_url'].split('?')[0]})}
+                for call in json.loads(post_args['batch'])]
+
+    def test_batch_chunks(self):
+        calls = [(str(i), {'fields': 'id'}) for i in range(120)]
+        with mock.patch.object(FacebookGraphAPI, 'request', side_effect=self.batch_response) as request:
+            responses = api_call_batch(calls)
+
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual([len(json.loads(c[1]['post_args']['batch'])) for c in request.call_args_list], [50, 50, 20])
+        self.assertEqual(json.loads(request.call_args_list[0][1]['post_args']['batch'])[1]['relative_url'], '1?fields=id')
+        self.assertEqual([response['id'] for response in responses], [str(i) for i in range(120)])
+
+    def test_batch_error_handling(self):
+        error = {'error': {'message': 'An unknown error has occurred.', 'type': 'OAuthException', 'code': 1}}
+        results = [{'code': 200, 'body': json.dumps({'id': '1'})}, {'code': 500, 'body': json.dumps(error)}]
+        with mock.patch.object(FacebookGraphAPI, 'request', return_value=results), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', return_value={'data': []}) as get_object:
+            responses = api_call_batch([('1', {}), ('2/likes', {'limit': 1000})])
+
+        self.assertEqual(responses, [{'id': '1'}, {'data': []}])
+        get_object.assert_called_once_with('2/likes', limit=500, methods_access_tag=None)
+
+
+class FacebookApiSchedulerTest(FacebookApiTestCase):
+
+    def test_scheduler_tokens_concurrency(self):
+        lock = threading.Lock()
+        calls = {'token1': 0, 'token2': 0}
+        calls_max = {'token1': 0, 'token2': 0}
+
+        def request(api, path, args=None, **kwargs):
+            with lock:
+                calls[api.access_token] += 1
+                calls_max[api.access_token] = max(calls[api.access_token], calls_max[api.access_token])
+            time.sleep(0.01)
+            with lock:
+                calls[api.access_token] -= 1
+            return {'id': path.split('/')[-1]}
+
+        with mock.patch.object(FacebookGraphAPI, 'request', autospec=True, side_effect=request):
+            with FacebookApiScheduler(workers=10, token_concurrency=2, tokens=['token1', 'token2']) as scheduler:
+                responses = scheduler.map([(str(i), {}) for i in range(20)])
+
+        self.assertEqual([response['id'] for response in responses], [str(i) for i in range(20)])
+        self.assertEqual(calls_max, {'token1': 2, 'token2': 2})
+
+    def test_get_async(self):
+        responses = {'1': {'id': '1', 'name': 'Object 1'}, '2': {'data': [{'id': '2', 'name': 'Object 2'}]}}
+        scheduler = FacebookApiScheduler(tokens=['token1'])
+        with mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=lambda path, **kw: responses[path]), \
+                mock.patch('facebook_api.scheduler.default_scheduler', scheduler):
+            results = [GraphObject.remote.get_async(graph_id) for graph_id in ['1', '2']]
+            instance, instances = [result.get() for result in results]
+        scheduler.close()
+
+        self.assertEqual(instance.name, 'Object 1')
+        self.assertEqual(instances[0].graph_id, '2')
+
+    def test_get_async_unsupported_fields(self):
+        def get_object(path, **kwargs):
+            if 'fields' in kwargs:
+                raise FacebookError({'error': {'code': 100, 'message': '(#100) Tried accessing nonexisting field'}})
+            return {'id': '1', 'name': 'Object 1'}
+
+        scheduler = FacebookApiScheduler(tokens=['token1'])
+        with mock.patch.object(GraphObject.remote, 'remote_fields_auto', True), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=get_object), \
+                mock.patch('facebook_api.scheduler.default_scheduler', scheduler):
+            instance = GraphObject.remote.get_async('1').get()
+            self.assertTrue(GraphObject.remote.remote_fields_auto)
+        scheduler.close()
+
+        self.assertEqual(instance.name, 'Object 1')
+
+    def test_get_pages_async(self):
+        requested = []
+
+        next_requested = threading.Event()
+
+        def get_object(path, after=None, **kwargs):
+            requested.append(after)
+            if after == '1':
+                next_requested.set()
+            page = int(after or 0)
+            response = {'data': [{'id': str(page), 'name': 'Object %d' % page}]}
+            if page < 2:
+                response['paging'] = {'cursors': {'after': str(page + 1)}, 'next': 'https://graph.facebook.com/next'}
+            return response
+
+        scheduler = FacebookApiScheduler(tokens=['token1'])
+        with mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=get_object), \
+                mock.patch('facebook_api.scheduler.default_scheduler', scheduler):
+            pages = GraphObject.timeline.get_pages_async('owner')
+            instances = next(pages)
+            # the next page is requested before the current one is processed
+            self.assertTrue(next_requested.wait(5))
+            self.assertEqual(requested, [None, '1'])
+            instances += sum(pages, [])
+        scheduler.close()
+        self.assertEqual([instance.graph_id for instance in instances], ['0', '1', '2'])
+
+
+class FacebookGraphManagerTest(FacebookApiTestCase):
+
+    def test_fetch_many(self):
+        response = dict([(str(i), {'id': str(i), 'name': 'Object %d' % i}) for i in range(60)])
+        ids = [str(i) for i in range(60)] + ['unknown']
+        with mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=lambda path, ids, **kw: response) as get_object:
+            instances = GraphObject.remote.fetch_many(ids)
+
+        self.assertEqual(get_object.call_count, 2)
+        self.assertEqual(len(get_object.call_args_list[0][1]['ids'].split(',')), 50)
+        self.assertEqual(instances.count(), 60)
+        self.assertEqual(GraphObject.objects.get(graph_id='7').name, 'Object 7')
+
+    def test_fetch_many_absent_objects(self):
+        def get_object(path, ids, **kwargs):
+            ids = ids.split(',')
+            if '3' in ids or '6' in ids:
+                raise FacebookError({'error': {'code': 100, 'message': '(#100) Some of the aliases you requested '
+                                                                      'do not exist: 3'}})
+            return dict([(graph_id, {'id': graph_id, 'name': 'Object %s' % graph_id}) for graph_id in ids])
+
+        with mock.patch.object(GraphObject.remote, 'ids_chunk_size', 4), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=get_object):
+            instances = GraphObject.remote.fetch_many([str(i) for i in range(8)])
+
+        self.assertEqual(sorted(instance.graph_id for instance in instances), ['0', '1', '2', '4', '5', '7'])
+
+        error = FacebookError({'error': {'code': 1, 'message': 'An unknown error has occurred'}})
+        with mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=error):
+            self.assertRaises(FacebookError, GraphObject.remote.fetch_many, ['1', '2'])
+
+    def test_bulk_get_or_create_from_instances(self):
+        GraphObject.objects.create(graph_id='1', name='Old name', likes_count=1)
+        GraphObject.objects.create(graph_id='2', name='Object 2', likes_count=2)
+        resources = [{'id': str(i), 'name': 'Object %d' % i, 'likes_count': i} for i in range(1, 6)]
+        resources += [{'id': '5', 'name': 'Object 5 duplicate', 'likes_count': 5}]
+        instances = GraphObject.remote.parse_response_list(resources)
+
+        signals = []
+        facebook_api_post_fetch_many.connect(lambda **kwargs: signals.append(kwargs), sender=GraphObject, weak=False)
+        facebook_api_post_fetch.connect(lambda **kwargs: signals.append(kwargs), sender=GraphObject, weak=False)
+        # savepoint, select existing, insert, select pks of inserted, update one changed row, release savepoint
+        with self.assertNumQueries(6):
+            GraphObject.remote.bulk_get_or_create_from_instances(instances)
+
+        self.assertEqual(GraphObject.objects.count(), 5)
+        self.assertEqual(GraphObject.objects.get(graph_id='1').name, 'Object 1')
+        self.assertEqual(GraphObject.objects.get(graph_id='5').name, 'Object 5 duplicate')
+        self.assertEqual(len(signals), 1)
+        self.assertEqual(len(signals[0]['instances']), 5)
+        self.assertEqual(len(signals[0]['created_instances']), 3)
+        self.assertTrue(all([instance.pk for instance in signals[0]['instances']]))
+
+    def test_parse(self):
+        instance = GraphObject.remote.parse_response_dict({
+            'id': '1', 'name': ' Object ', 'likes_count': '10', 'created_time': '2015-10-01T10:00:00+0000',
+            'unknown': 'value'})
+
+        self.assertEqual(instance.graph_id, '1')
+        self.assertEqual(instance.name, 'Object')
+        self.assertEqual(instance.likes_count, 10)
+        self.assertEqual(instance.created_time, datetime(2015, 10, 1, 10, tzinfo=timezone.utc))
+        self.assertFalse(hasattr(instance, 'unknown'))
+        self.assertEqual(set(GraphObject.get_parse_plan()), set(['id', 'graph_id', 'name', 'likes_count',
+                                                                 'created_time']))
+
+    def test_nested_resources_deduplication(self):
+        resources = [{'id': str(i), 'name': 'Child %d' % i, 'parent': {'id': 'p', 'name': 'Parent'}} for i in range(5)]
+        instances = GraphChildObject.remote.parse_response_list(resources)
+        self.assertEqual(len(set([id(instance.parent) for instance in instances])), 1)
+
+        with mock.patch.object(GraphObject.remote, 'get_or_create_from_instance') as get_or_create_from_instance, \
+                CaptureQueriesContext(connection) as context:
+            GraphChildObject.remote.get_or_create_from_instances_list(instances)
+
+        self.assertFalse(get_or_create_from_instance.called)
+        self.assertLess(len(context.captured_queries), 15)
+        self.assertEqual(GraphObject.objects.count(), 1)
+        self.assertEqual(GraphChildObject.objects.filter(parent__graph_id='p').count(), 5)
+
+    def test_bulk_save_of_overridden_save(self):
+        self.assertTrue(GraphObject.remote.is_bulk_save())
+        self.assertFalse(GraphSavedObject.remote.is_bulk_save())
+
+        instances = [GraphSavedObject(graph_id=str(i), name='name %d' % i) for i in range(3)]
+        with mock.patch.object(GraphSavedObject.remote, 'bulk_get_or_create_from_instances') as bulk_save:
+            GraphSavedObject.remote.get_or_create_from_instances_list(instances)
+        self.assertFalse(bulk_save.called)
+        self.assertEqual(GraphSavedObject.objects.get(graph_id='1').name, 'NAME 1')
+
+        with mock.patch.object(GraphSavedObject.remote, 'bulk_save', True):
+            self.assertTrue(GraphSavedObject.remote.is_bulk_save())
+
+    def test_external_links_to_add(self):
+        album = GraphAlbum.objects.create(graph_id='1', name='Album')
+        objects = [GraphObject.objects.create(graph_id=str(i), name='Object %d' % i) for i in range(3)]
+        photos = [GraphPhoto.objects.create(graph_id='1_%d' % i, album=album) for i in range(2)]
+        album.objects_tagged.add(objects[0], objects[1])
+
+        actions = []
+        m2m_changed.connect(lambda action, pk_set, **kwargs: actions.append((action, pk_set)),
+                            sender=GraphAlbum.objects_tagged.through, weak=False, dispatch_uid='test_links')
+        try:
+            album._external_links_to_add = {'objects_tagged': [objects[1], objects[2]],
+                                            'photos': [photos[1], GraphPhoto(graph_id='1_2')]}
+            album.save()
+        finally:
+            m2m_changed.disconnect(sender=GraphAlbum.objects_tagged.through, dispatch_uid='test_links')
+
+        # only changed links are removed and added
+        self.assertEqual(sorted(album.objects_tagged.values_list('graph_id', flat=True)), ['1', '2'])
+        self.assertIn(('post_remove', set([objects[0].pk])), actions)
+        self.assertIn(('post_add', set([objects[2].pk])), actions)
+        self.assertEqual(GraphObject.objects.count(), 3)
+        # children of reverse foreign key, absent in the list, are deleted
+        self.assertEqual(sorted(album.photos.values_list('graph_id', flat=True)), ['1_1', '1_2'])
+        self.assertEqual(GraphPhoto.objects.count(), 2)
+
+    def test_bulk_external_links_post_save(self):
+        instances = []
+        for i in range(3):
+            instance = GraphObject(graph_id=str(i), name='Object %d' % i)
+            instance._external_links_post_save = [('parent', GraphChildObject(graph_id='%d_%d' % (i, j)))
+                                                  for j in range(4)]
+            instances += [instance]
+
+        with mock.patch.object(GraphChildObject.remote, 'bulk_get_or_create_from_instances',
+                               wraps=GraphChildObject.remote.bulk_get_or_create_from_instances) as bulk_save:
+            GraphObject.remote.bulk_get_or_create_from_instances(instances)
+
+        self.assertEqual(bulk_save.call_count, 1)
+        self.assertEqual(GraphChildObject.objects.count(), 12)
+        self.assertEqual(GraphChildObject.objects.filter(parent__graph_id='1').count(), 4)
+
+    def test_remote_fields(self):
+        self.assertEqual(GraphObject.get_remote_fields(), ['created_time', 'id', 'likes_count', 'name'])
+
+        with mock.patch.object(FacebookGraphAPI, 'get_object', return_value={'id': '1'}) as get_object:
+            # fields are not requested, until model declares them or projection is switched on
+            GraphObject.remote.get('1')
+            self.assertNotIn('fields', get_object.call_args[1])
+            with mock.patch.object(GraphObject, 'remote_fields', ['id', 'name']):
+                GraphObject.remote.get('1')
+                self.assertEqual(get_object.call_args[1]['fields'], 'id,name')
+            with mock.patch.object(GraphObject.remote, 'remote_fields_auto', True):
+                GraphObject.remote.get('1')
+                self.assertEqual(get_object.call_args[1]['fields'], 'created_time,id,likes_count,name')
+            GraphObject.remote.get('1', fields='id')
+            self.assertEqual(get_object.call_args[1]['fields'], 'id')
+
+    def test_remote_fields_of_mixins(self):
+        self.assertEqual(GraphComment.get_remote_fields(2.3),
+                         ['from', 'id', 'likes.limit(0).summary(true)', 'message'])
+        # reactions are requested only by API version, which supports them
+        self.assertNotIn('reactions.limit(0).summary(true)', GraphPost.get_remote_fields(2.3))
+        self.assertIn('likes.limit(0).summary(true)', GraphPost.get_remote_fields(2.3))
+        self.assertIn('reactions.type(LOVE).limit(0).summary(true).as(reactions_love)',
+                      GraphPost.get_remote_fields(2.6))
+
+        response = {'id': '1', 'message': 'Message', 'likes': {'data': [], 'summary': {'total_count': 5}},
+                    'reactions_love': {'data': [], 'summary': {'total_count': 2}}}
+        with mock.patch.object(GraphComment.remote, 'remote_fields_auto', True), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', return_value=response) as get_object:
+            comment = GraphComment.remote.fetch('1')
+            self.assertIn('likes.limit(0).summary(true)', get_object.call_args[1]['fields'].split(','))
+
+        self.assertEqual(GraphComment.objects.get(pk=comment.pk).likes_count, 5)
+        post = GraphPost.remote.parse_response_dict(response)
+        self.assertEqual((post.likes_count, post.loves_count), (5, 2))
+
+    def test_refresh_counters(self):
+        instances = [GraphObject.objects.create(graph_id=str(i), name='Object %d' % i, likes_count=0) for i in [1, 2]]
+        response = {
+            '1': {'id': '1', 'likes': {'data': [], 'summary': {'total_count': 10}}},
+            '2': {'id': '2', 'likes': {'data': [], 'summary': {'total_count': 20}}},
+        }
+        with mock.patch.object(GraphObject, 'counters_fields', {'likes_count': 'likes.limit(0).summary(true)'},
+                               create=True), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', return_value=response) as get_object:
+            GraphObject.remote.refresh_counters(instances)
+
+        self.assertEqual(get_object.call_count, 1)
+        self.assertEqual(get_object.call_args[1]['fields'], 'id,likes.limit(0).summary(true)')
+        self.assertEqual(GraphObject.objects.get(graph_id='1').likes_count, 10)
+        self.assertEqual(GraphObject.objects.get(graph_id='2').likes_count, 20)
+        self.assertEqual(get_expansion_key('reactions.type(LOVE).limit(0).summary(true).as(reactions_love)'),
+                         'reactions_love')
+
+    def test_remote_fields_unsupported(self):
+        def get_object(path, **kwargs):
+            if 'fields' in kwargs:
+                raise FacebookError({'error': {'code': 100, 'message': '(#100) Tried accessing nonexisting field'}})
+            return {'id': '1', 'name': 'Object 1'}
+
+        with mock.patch.object(GraphObject.remote, 'remote_fields_auto', True), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=get_object) as get_object_mock:
+            instance = GraphObject.remote.fetch('1')
+            # fields are requested again by the next call
+            self.assertTrue(GraphObject.remote.remote_fields_auto)
+            self.assertEqual(get_object_mock.call_count, 2)
+            self.assertNotIn('fields', get_object_mock.call_args_list[1][1])
+
+        self.assertEqual(instance.name, 'Object 1')
+
+    def test_remote_fields_absent_object(self):
+        error = FacebookError({'error': {'code': 100, 'message': '(#100) Unsupported get request.'}})
+        with mock.patch.object(GraphObject.remote, 'remote_fields_auto', True), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=error) as get_object:
+            self.assertRaises(FacebookError, GraphObject.remote.fetch, '1')
+            self.assertEqual(get_object.call_count, 1)
+            self.assertTrue(GraphObject.remote.remote_fields_auto)
+
+
+@override_settings(USE_TZ=True)
+class FacebookGraphTimelineManagerTest(FacebookApiTestCase):
+
+    def get_response(self, *dates):
+        return {'data': [{'id': str(i), 'created_time': date} for i, date in enumerate(dates)]}
+
+    def test_checkpoint(self):
+        with mock.patch.object(FacebookGraphAPI, 'get_object') as get_object:
+            get_object.return_value = self.get_response('2015-10-01T10:00:00+0000', '2015-10-02T10:00:00+0000')
+            # checkpoint is not moved, until items are saved
+            GraphObject.timeline.get('owner')
+            self.assertIsNone(TimelineCheckpoint.objects.get().date)
+            GraphObject.timeline.fetch('owner')
+            self.assertNotIn('since', get_object.call_args[1])
+
+            checkpoint = TimelineCheckpoint.objects.get(owner_id='owner', resource_path='%s/objects')
+            self.assertEqual(checkpoint.date, datetime(2015, 10, 2, 10, tzinfo=timezone.utc))
+
+            get_object.return_value = self.get_response('2015-10-03T10:00:00+0000', '2015-10-02T10:00:00+0000')
+            instances = GraphObject.timeline.fetch('owner')
+            since = get_object.call_args[1]['since']
+            self.assertEqual(len(instances), 2)
+
+            # the next page uses the same value of since, in spite of new checkpoint
+            get_object.return_value = self.get_response('2015-10-02T09:30:00+0000', '2015-09-01T10:00:00+0000')
+            instances = GraphObject.timeline.fetch('owner', after='cursor')
+            self.assertEqual(get_object.call_args[1]['since'], since)
+            self.assertEqual(len(instances), 1)
+
+            GraphObject.timeline.fetch('owner', checkpoint=False)
+            self.assertNotIn('since', get_object.call_args[1])
+
+        checkpoint = TimelineCheckpoint.objects.get(owner_id='owner', resource_path='%s/objects')
+        self.assertEqual(checkpoint.date, datetime(2015, 10, 3, 10, tzinfo=timezone.utc))
+        self.assertEqual(checkpoint.since, datetime(2015, 10, 2, 9, tzinfo=timezone.utc))
+
+    def test_checkpoint_explicit_until(self):
+        TimelineCheckpoint.objects.create(model='facebook_api.graphobject', owner_id='owner',
+                                          resource_path='%s/objects', date=datetime(2016, 10, 1, tzinfo=timezone.utc),
+                                          since=datetime(2016, 9, 30, tzinfo=timezone.utc))
+        with mock.patch.object(FacebookGraphAPI, 'get_object') as get_object:
+            get_object.return_value = self.get_response('2014-05-10T10:00:00+0000', '2014-05-09T10:00:00+0000')
+            # historical request is not limited by checkpoint
+            with self.assertRaises(ValueError):
+                GraphObject.timeline.get('owner', until=1400000000)
+            instances = GraphObject.timeline.get('owner', since=1390000000, until=1400000000)
+            self.assertEqual(get_object.call_args[1]['since'], 1390000000)
+            self.assertEqual(len(instances), 2)
+
+        self.assertEqual(TimelineCheckpoint.objects.get().date, datetime(2016, 10, 1, tzinfo=timezone.utc))
+
+    def test_checkpoint_not_finished_pass(self):
+        with mock.patch.object(FacebookGraphAPI, 'get_object') as get_object:
+            get_object.return_value = self.get_response('2015-10-02T10:00:00+0000')
+            GraphObject.timeline.fetch('owner')
+
+            # the first page of pass, the next page is failed
+            response = self.get_response('2015-10-05T10:00:00+0000', '2015-10-04T10:00:00+0000')
+            response['paging'] = {'next': 'https://graph.facebook.com/next?after=cursor'}
+            get_object.return_value = response
+            GraphObject.timeline.fetch('owner')
+            checkpoint = TimelineCheckpoint.objects.get()
+            self.assertEqual(checkpoint.date, datetime(2015, 10, 2, 10, tzinfo=timezone.utc))
+            self.assertEqual(checkpoint.pass_date, datetime(2015, 10, 5, 10, tzinfo=timezone.utc))
+
+            # the new pass starts from the previous date
+            get_object.return_value = response
+            GraphObject.timeline.fetch('owner')
+            self.assertEqual(get_object.call_args[1]['since'], int(time.mktime(datetime(2015, 10, 2, 9).timetuple())))
+
+            # the last page of pass
+            get_object.return_value = self.get_response('2015-10-03T10:00:00+0000')
+            GraphObject.timeline.fetch('owner', after='cursor')
+
+        checkpoint = TimelineCheckpoint.objects.get()
+        self.assertEqual(checkpoint.date, datetime(2015, 10, 5, 10, tzinfo=timezone.utc))
+        self.assertIsNone(checkpoint.pass_date)
+
+    def test_since_crossed(self):
+        response = self.get_response('2015-10-01T10:00:00+0000', '2015-10-03T10:00:00+0000', '2015-09-01T10:00:00+0000')
+        response['paging'] = {'cursors': {'after': 'cursor'}, 'next': 'https://graph.facebook.com/next?after=cursor'}
+        with mock.patch.object(FacebookGraphAPI, 'get_object', return_value=response):
+            instances = GraphObject.timeline.get('owner', since=datetime(2015, 9, 15, tzinfo=timezone.utc))
+
+        self.assertEqual([instance.graph_id for instance in instances], ['1', '0'])
+        self.assertNotIn('paging', GraphObject.timeline.response)
+
+    def test_backfill(self):
+        def get_object(path, since, until, after=None, **kwargs):
+            # two items per day, one item per page
+            day = datetime.utcfromtimestamp(until).replace(tzinfo=timezone.utc) - timedelta(hours=12)
+            date = day - timedelta(hours=6) if after else day
+            response = {'data': [{'id': date.strftime('%m%d%H'), 'created_time': date.isoformat()}]}
+            if not after:
+                response['paging'] = {'next': 'https://graph.facebook.com/next?access_token=token&after=cursor'}
+            return response
+
+        since = datetime(2015, 10, 1, tzinfo=timezone.utc)
+        until = datetime(2015, 10, 4, tzinfo=timezone.utc)
+        with mock.patch('facebook_api.scheduler.FacebookApi.get_tokens', return_value=['token1', 'token2']), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', side_effect=get_object) as get_object:
+            count = GraphObject.timeline.backfill('owner', since, until, slice_size=timedelta(days=1), workers=2)
+            self.assertEqual(get_object.call_count, 6)
+
+            # completed slices are not requested again
+            GraphObject.timeline.backfill('owner', since, until, slice_size=timedelta(days=1))
+            self.assertEqual(get_object.call_count, 6)
+
+        self.assertEqual(count, 6)
+        self.assertEqual(GraphObject.objects.count(), 6)
+        self.assertEqual(TimelineSlice.objects.filter(completed=True).count(), 3)
+
+    def test_backfill_without_until(self):
+        since = timezone.now() - timedelta(days=3, hours=12)
+        with mock.patch('facebook_api.scheduler.FacebookApi.get_tokens', return_value=['token1']), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', return_value={'data': []}) as get_object:
+            GraphObject.timeline.backfill('owner', since, slice_size=timedelta(days=1))
+            self.assertEqual(get_object.call_count, 4)
+
+            # the same slices are resumed in the next run
+            TimelineSlice.objects.filter(until__lte=since + timedelta(days=2)).update(completed=False)
+            GraphObject.timeline.backfill('owner', since, slice_size=timedelta(days=1))
+            self.assertEqual(get_object.call_count, 6)
+
+        self.assertEqual(TimelineSlice.objects.count(), 4)
+        self.assertEqual(TimelineSlice.objects.order_by('-until')[0].until, since + timedelta(days=4))
+
+
+class MixinsTest(FacebookApiTestCase):
+
+    def setUp(self):
+        super(MixinsTest, self).setUp()
+        small_resources_cache.clear()
+        self.post = GraphPost.objects.create(graph_id='1', message='Post')
+
+    def get_response(self, resources, after=None):
+        response = {'data': resources}
+        if after:
+            response['paging'] = {'cursors': {'after': after}, 'next': 'https://graph.facebook.com/next?after=%s' % after}
+        return response
+
+    def fetch(self, method, pages, *args, **kwargs):
+        """
+        Call method of post with mocked pages of API response {value of `after`: response}, return result,
+        number of API calls and number of saves of post
+        """
+        save = GraphPost.save
+        with mock.patch('facebook_api.mixins.api_call', side_effect=lambda path, after=None, **kw: pages[after]) \
+                as call, \
+                mock.patch('facebook_api.utils.get_small_resource_model',
+                           side_effect=lambda resource: (User, {'name': resource['name'], 'verified': False})), \
+                mock.patch.object(GraphPost, 'save', autospec=True, side_effect=save) as save:
+            result = getattr(self.post, method)(*args, **kwargs)
+        return result, call.call_count, save.call_count
+
+    def test_fetch_reactions(self):
+        pages = {
+            None: self.get_response([{'id': '1', 'name': 'User 1', 'type': 'LOVE'},
+                                     {'id': '2', 'name': 'User 2', 'type': 'LIKE'}], 'cursor'),
+            'cursor': self.get_response([{'id': '3', 'name': 'User 3', 'type': 'LOVE'},
+                                         {'id': '4', 'name': 'User 4', 'type': 'WOW'},
+                                         {'id': '5', 'name': 'User 5'}]),
+        }
+        result, calls, saves = self.fetch('fetch_reactions', pages)
+        self.assertEqual((calls, saves), (2, 1))
+        self.assertEqual(sorted(result['LOVE'].values_list('graph_id', flat=True)), ['1', '3'])
+
+        post = GraphPost.objects.get(pk=self.post.pk)
+        counts = dict([(reaction, getattr(post, '%ss_count' % reaction)) for reaction in post.reaction_types + ['like']])
+        self.assertEqual(counts, {'love': 2, 'wow': 1, 'haha': 0, 'sad': 0, 'angry': 0, 'thankful': 0, 'like': 1})
+        self.assertEqual(sorted(post.loves_users.values_list('graph_id', flat=True)), ['1', '3'])
+        self.assertEqual(list(post.likes_users.values_list('graph_id', flat=True)), ['2'])
+        self.assertEqual(list(post.wows_users.values_list('graph_id', flat=True)), ['4'])
+        self.assertEqual(post.sads_users.count(), 0)
+
+        result, calls, saves = self.fetch('fetch_reactions', pages, reaction='wow')
+        self.assertEqual((calls, saves), (2, 1))
+        self.assertIsInstance(result, QuerySet)
+        self.assertEqual(list(result.values_list('graph_id', flat=True)), ['4'])
+
+    def sync_likes(self, pages):
+        """
+        Sync likes of post, return numbers of API calls and saves of post and lists of changes of likes
+        """
+        changes = []
+
+        def receiver(action, pk_set, **kwargs):
+            if action in ['post_add', 'post_remove']:
+                graph_ids = User.objects.filter(pk__in=pk_set).values_list('graph_id', flat=True)
+                changes.append((action, sorted(graph_ids)))
+
+        m2m_changed.connect(receiver, sender=GraphPost.likes_users.through)
+        try:
+            result, calls, saves = self.fetch('sync_likes', pages)
+        finally:
+            m2m_changed.disconnect(receiver, sender=GraphPost.likes_users.through)
+
+        self.post = GraphPost.objects.get(pk=self.post.pk)
+        self.assertEqual(sorted(result.values_list('graph_id', flat=True)),
+                         sorted(self.post.likes_users.values_list('graph_id', flat=True)))
+        return calls, saves, changes
+
+    def get_users(self, *graph_ids):
+        return [{'id': graph_id, 'name': 'User %s' % graph_id} for graph_id in graph_ids]
+
+    def test_sync_likes(self):
+        # the first sync requests all pages
+        calls, saves, changes = self.sync_likes({
+            None: self.get_response(self.get_users('1', '2'), 'cursor1'),
+            'cursor1': self.get_response(self.get_users('3')),
+        })
+        self.assertEqual((calls, saves), (2, 1))
+        self.assertEqual(changes, [('post_add', ['1', '2']), ('post_add', ['3'])])
+        self.assertEqual(self.post.likes_count, 3)
+
+        # stops on the page with only known users, only new users are added
+        calls, saves, changes = self.sync_likes({
+            None: self.get_response(self.get_users('4', '1'), 'cursor1'),
+            'cursor1': self.get_response(self.get_users('2', '3'), 'cursor2'),
+            'cursor2': self.get_response(self.get_users('5')),
+        })
+        self.assertEqual((calls, saves), (2, 1))
+        self.assertEqual(changes, [('post_add', ['4'])])
+        self.assertEqual(self.post.likes_count, 4)
+        self.assertEqual(sorted(self.post.likes_users.values_list('graph_id', flat=True)), ['1', '2', '3', '4'])
+
+        # absent users are removed only after requesting of all pages
+        calls, saves, changes = self.sync_likes({
+            None: self.get_response(self.get_users('6', '4')),
+        })
+        self.assertEqual((calls, saves), (1, 1))
+        self.assertEqual(changes, [('post_add', ['6']), ('post_remove', ['1', '2', '3'])])
+        self.assertEqual(self.post.likes_count, 2)
+        self.assertEqual(sorted(self.post.likes_users.values_list('graph_id', flat=True)), ['4', '6'])
+
+
+class SmallResourcesTest(FacebookApiTestCase):
+
+    def setUp(self):
+        super(SmallResourcesTest, self).setUp()
+        small_resources_cache.clear()
+
+    @mock.patch('facebook_api.utils.get_small_resource_model', side_effect=lambda r: (GraphObject, {'name': r['name']}))
+    def test_get_or_create_from_small_resource_cache(self, *args):
+        instance = GraphObject.objects.create(graph_id='1', name='Name')
+
+        with self.assertNumQueries(1):
+            for i in range(3):
+                self.assertEqual(get_or_create_from_small_resource({'id': '1', 'name': 'Name'}).pk, instance.pk)
+        self.assertEqual((small_resources_cache.hits, small_resources_cache.misses), (2, 1))
+
+        # created inside transaction objects are not cached
+        get_or_create_from_small_resource({'id': '2', 'name': 'Name'})
+        self.assertNotIn((GraphObject, u'2'), small_resources_cache)
+
+    def test_invalidate_deleted_small_resource(self):
+        user = User.objects.create(graph_id='1', name='Name', verified=False)
+        small_resources_cache.set((User, u'1'), user.pk)
+        user.delete()
+        self.assertNotIn((User, u'1'), small_resources_cache)
+
+        # querysets of other models are still deleted fast
+        self.assertFalse(post_delete.has_listeners(GraphObject))
+
+    def test_get_or_create_from_small_resources(self):
+        def get_small_resource_model(resource):
+            if 'name' not in resource:
+                raise UnknownResourceType()
+            return GraphObject, {'name': resource['name']}
+
+        GraphObject.objects.create(graph_id='1', name='Name')
+        resources = [{'id': str(i), 'name': 'Name %d' % i} for i in range(1, 1001)] + [{'id': '0'}]
+        with mock.patch('facebook_api.utils.get_small_resource_model', side_effect=get_small_resource_model):
+            with CaptureQueriesContext(connection) as queries:
+                pks = get_or_create_from_small_resources(resources)
+
+        # selects of existing and created by chunks, inserts by backend-specific batches, savepoint
+        self.assertLess(len(queries), 15)
+
+        self.assertEqual(len(pks), 1000)
+        self.assertEqual(GraphObject.objects.count(), 1000)
+        self.assertEqual(pks['500'], GraphObject.objects.get(graph_id='500').pk)
+        # found objects are stored in identity map, created inside transaction are not
+        self.assertIn((GraphObject, u'1'), small_resources_cache)
+        self.assertNotIn((GraphObject, u'500'), small_resources_cache)
+        pk = GraphObject.objects.get(graph_id='1').pk
+        with mock.patch('facebook_api.utils.get_small_resource_model', side_effect=get_small_resource_model):
+            with self.assertNumQueries(0):
+                self.assertEqual(get_or_create_from_small_resources([{'id': '1', 'name': 'Name 1'}]), {'1': pk})
+            with self.assertNumQueries(1):
+                self.assertEqual(get_or_create_from_small_resource({'id': '1', 'name': 'Name 1'}).name, 'Name')
+
+        # created in the same order by all processes
+        self.assertEqual(list(GraphObject.objects.exclude(graph_id='1').order_by('pk').values_list('graph_id', flat=True)),
+                         sorted([str(i) for i in range(2, 1001)]))
+
+
+class LockObjectTest(TransactionTestCase):
+
+    def setUp(self):
+        self.instance = GraphObject.objects.create(graph_id='1', name='Name')
+
+    def hold_lock(self, acquired, release):
+        try:
+            with lock_object(self.instance, 'likes_users'):
+                acquired.set()
+                release.wait(5)
+        finally:
+            connection.close()
+
+    @mock.patch('facebook_api.utils.INGESTION_LOCK', 'cache')
+    def test_cache_lock(self):
+        first_acquired, first_release = threading.Event(), threading.Event()
+        second_acquired, second_release = threading.Event(), threading.Event()
+        first = threading.Thread(target=self.hold_lock, args=(first_acquired, first_release))
+        second = threading.Thread(target=self.hold_lock, args=(second_acquired, second_release))
+
+        first.start()
+        self.assertTrue(first_acquired.wait(5))
+        second.start()
+        # the second process waits until the first one releases the lock
+        self.assertFalse(second_acquired.wait(0.3))
+        first_release.set()
+        self.assertTrue(second_acquired.wait(5))
+        second_release.set()
+        first.join()
+        second.join()
+
+        # lock of another object is independent
+        self.assertNotEqual(get_lock_key(GraphObject(pk=self.instance.pk + 1), 'likes_users'),
+                            get_lock_key(self.instance, 'likes_users'))
+
+    @mock.patch('facebook_api.utils.INGESTION_LOCK', 'cache')
+    def test_transaction(self):
+        from django.core.cache import cache
+        self.assertFalse(connection.in_atomic_block)
+        with self.assertRaises(ValueError):
+            with lock_object(self.instance, 'likes_users'):
+                self.assertTrue(connection.in_atomic_block)
+                GraphObject.objects.filter(pk=self.instance.pk).update(name='New name')
+                raise ValueError()
+
+        # changes are rolled back and lock is released
+        self.assertEqual(GraphObject.objects.get(pk=self.instance.pk).name, 'Name')
+        self.assertIsNone(cache.get(get_lock_key(self.instance, 'likes_users')))
+
+    @mock.patch('facebook_api.utils.INGESTION_LOCK', 'cache')
+    @mock.patch('facebook_api.utils.INGESTION_LOCK_ACQUIRE_TIMEOUT', 0.2)
+    def test_cache_lock_timeout(self):
+        from django.core.cache import cache
+        key = get_lock_key(self.instance, 'likes_users')
+        cache.set(key, 'token of another process')
+        try:
+            with self.assertRaises(LockTimeout):
+                with lock_object(self.instance, 'likes_users'):
+                    pass
+            # lock of another process is not released
+            self.assertEqual(cache.get(key), 'token of another process')
+
+            # lock expired and acquired by another process is not released by the previous owner
+            with lock_object(GraphObject(pk=self.instance.pk + 1), 'likes_users'):
+                key_expired = get_lock_key(GraphObject(pk=self.instance.pk + 1), 'likes_users')
+                cache.set(key_expired, 'token of another process')
+            self.assertEqual(cache.get(key_expired), 'token of another process')
+        finally:
+            cache.clear()
+
+    @mock.patch('facebook_api.utils.INGESTION_LOCK', 'advisory')
+    def test_advisory_lock(self):
+        with mock.patch.object(connection, 'cursor') as cursor:
+            with lock_object(self.instance, 'likes_users'):
+                pass
+        # advisory lock is ignored by other backends
+        self.assertNotIn('pg_advisory_xact_lock', str(cursor.mock_calls))
+
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'cursor') as cursor:
+            with lock_object(self.instance, 'likes_users'):
+                self.assertTrue(connection.in_atomic_block)
+        cursor.return_value.execute.assert_any_call(
+            'SELECT pg_advisory_xact_lock(%s)', [zlib.crc32(get_lock_key(self.instance, 'likes_users'))])
+
+
+@mock.patch('facebook_api.routers.REPLICA_DATABASES', ['replica'])
+class RoutersTest(TestCase):
+
+    def setUp(self):
+        routers.state.written_at = 0
+
+    def test_read_your_writes(self):
+        self.assertEqual(get_read_database(), 'replica')
+
+        with read_your_writes:
+            self.assertEqual(get_read_database(), 'replica')
+            self.assertEqual(get_write_database(), 'default')
+            # reads are pinned to master until the end of scope
+            with mock.patch('facebook_api.routers.REPLICA_PIN_TIMEOUT', 0):
+                self.assertEqual(get_read_database(), 'default')
+            with read_your_writes:
+                pass
+            self.assertEqual(get_read_database(), 'default')
+
+        # and during timeout after it
+        self.assertEqual(get_read_database(), 'default')
+        with mock.patch('facebook_api.routers.REPLICA_PIN_TIMEOUT', 0):
+            self.assertEqual(get_read_database(), 'replica')
+
+    def test_pinning_by_writes_only(self):
+        # reading from master doesn't pin reads
+        GraphObject.timeline.get_timeline_checkpoint('owner')
+        self.assertEqual(get_read_database(), 'replica')
+
+        instance = GraphObject.objects.create(graph_id='1', name='Object 1', likes_count=0)
+        response = {'1': {'id': '1', 'likes': {'data': [], 'summary': {'total_count': 10}}}}
+        with mock.patch.object(GraphObject, 'counters_fields', {'likes_count': 'likes.limit(0).summary(true)'},
+                               create=True), \
+                mock.patch.object(FacebookGraphAPI, 'get_object', return_value=response):
+            GraphObject.remote.refresh_counters([instance])
+        self.assertEqual(get_read_database(), 'default')
+
+    def test_router(self):
+        router = FacebookApiRouter()
+        self.assertEqual(router.db_for_read(GraphObject), 'replica')
+        self.assertEqual(router.db_for_write(GraphObject), 'default')
+        self.assertEqual(router.db_for_read(GraphObject), 'default')
+        self.assertFalse(router.allow_migrate('replica', GraphObject))
+        self.assertIsNone(router.allow_migrate('default', GraphObject))
+
+        instance = GraphObject(graph_id='1')
+        instance._state.db = 'replica'
+        self.assertTrue(router.allow_relation(instance, GraphObject.objects.create(graph_id='2')))
+
+
+class DatesTest(TestCase):
+
+    def test_parse_datetime(self):
+        import dateutil.parser
+        for value in ['2015-10-01T10:20:30+0000', '2015-10-01T10:20:30+0300', '2015-10-01T10:20:30-0130',
+                      '2015-10-01T10:20:30Z', '2015-10-01', '2015-10-01T10:20:30.000+0000']:
+            self.assertEqual(parse_datetime(value), dateutil.parser.parse(value))
+            self.assertEqual(parse_datetime(value).utcoffset(), dateutil.parser.parse(value).utcoffset())
+
+
+class FetchAllTest(FacebookApiTestCase):
+
+    class Paginated(object):
+        pages = 3000
+
+        @fetch_all(paging_next_arg_name='after')
+        def fetch_items(self, after=None, **kwargs):
+            page = int(after or 0)
+            response = {'paging': {'cursors': {'after': str(page + 1)}}} if page + 1 < self.pages else {}
+            return [page], response
+
+    def test_fetch_all_pages(self):
+        # number of pages is more, than recursion limit
+        self.assertEqual(self.Paginated().fetch_items(all=True), range(3000))
+        self.assertEqual(self.Paginated().fetch_items(), [0])
+
+    def test_fetch_all_as_iterator(self):
+        pages = self.Paginated().fetch_items(as_iterator=True)
+        self.assertEqual(next(pages), [0])
+        self.assertEqual(next(pages), [1])
+        self.assertEqual(len(list(pages)), 2998)
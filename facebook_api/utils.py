@@ -13,7 +13,27 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 '''
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+import uuid
+import zlib
+
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, IntegrityError
+from django.db.models.signals import post_delete
+
+from .decorators import atomic
+
+SMALL_RESOURCES_CACHE_SIZE = getattr(settings, 'FACEBOOK_API_SMALL_RESOURCES_CACHE_SIZE', 10000)
+# serialization of concurrent saving of relations of the same object: None, 'advisory' (PostgreSQL) or 'cache'
+INGESTION_LOCK = getattr(settings, 'FACEBOOK_API_INGESTION_LOCK', None)
+INGESTION_LOCK_TIMEOUT = getattr(settings, 'FACEBOOK_API_INGESTION_LOCK_TIMEOUT', 60)
+INGESTION_LOCK_CACHE_ALIAS = getattr(settings, 'FACEBOOK_API_INGESTION_LOCK_CACHE_ALIAS', 'default')
+# seconds of waiting for lock in cache, after which LockTimeout is raised
+INGESTION_LOCK_ACQUIRE_TIMEOUT = getattr(settings, 'FACEBOOK_API_INGESTION_LOCK_ACQUIRE_TIMEOUT', 120)
 
 
 def get_improperly_configured_field(app_name, decorate_property=False):
@@ -28,10 +48,68 @@ class UnknownResourceType(Exception):
     pass
 
 
-def get_or_create_from_small_resource(resource):
-    '''
-    Return instance of right type based on dictionary resource from Facebook API Graph
-    '''
+class LockTimeout(Exception):
+    pass
+
+
+class LRUCache(object):
+    """
+    Thread-safe dictionary with limited size, which removes the least recently used items.
+    Counts hits and misses of `get` method
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # move item to the end as recently used
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# identity map of pages, applications and users: (model, graph_id) -> instance or pk of instance
+small_resources_cache = LRUCache(SMALL_RESOURCES_CACHE_SIZE)
+
+
+def get_small_resource_model(resource):
+    """
+    Return model and dictionary of default field values based on dictionary resource from Facebook API Graph
+    """
     from facebook_applications.models import Application
     from facebook_pages.models import Page
     from facebook_users.models import User
@@ -43,14 +121,163 @@ def get_or_create_from_small_resource(resource):
         # resource is a page
         if 'category_list' in defaults:
             del defaults['category_list']
-        return Page.objects.get_or_create(graph_id=resource['id'], defaults=defaults)[0]
+        return Page, defaults
     elif keys == ['id', 'name', 'namespace']:
         # resource is a application
-        return Application.objects.get_or_create(graph_id=resource['id'], defaults=defaults)[0]
+        return Application, defaults
     elif keys == ['id', 'name'] or keys == ['id'] or keys == ['id', 'name', 'type']:
         # resource is a user
         if 'type' in defaults:
             del defaults['type']
-        return User.objects.get_or_create(graph_id=resource['id'], defaults=defaults)[0]
+        return User, defaults
     else:
         raise UnknownResourceType("Strange structure of resource: %s" % resource)
+
+
+def get_or_create_from_small_resource(resource):
+    '''
+    Return instance of right type based on dictionary resource from Facebook API Graph
+    '''
+    model, defaults = get_small_resource_model(resource)
+    key = (model, unicode(resource['id']))
+
+    instance = small_resources_cache.get(key)
+    if instance is not None and not isinstance(instance, model):
+        # only pk is stored by get_or_create_from_small_resources()
+        instance = model.objects.filter(pk=instance).first()
+        if instance is not None:
+            small_resources_cache.set(key, instance)
+    if instance is None:
+        instance, created = model.objects.get_or_create(graph_id=resource['id'], defaults=defaults)
+        # created object will disappear after rollback of transaction, so cache it only outside of transaction
+        if not created or not connections[router.db_for_write(model)].in_atomic_block:
+            small_resources_cache.set(key, instance)
+
+    return instance
+
+
+def get_or_create_from_small_resources(resources):
+    """
+    Return dictionary {graph_id: pk} of instances of right types based on list of dictionary resources
+    from Facebook API Graph. Instances of every type are selected and created in bulk.
+    Resources with unknown structure are skipped
+    """
+    result = {}
+    models_resources = {}
+    for resource in resources:
+        try:
+            model, defaults = get_small_resource_model(resource)
+        except UnknownResourceType:
+            continue
+
+        graph_id = unicode(resource['id'])
+        instance = small_resources_cache.get((model, graph_id))
+        if instance is not None:
+            result[graph_id] = instance.pk if isinstance(instance, model) else instance
+        else:
+            models_resources.setdefault(model, {})[graph_id] = defaults
+
+    for model, resources in models_resources.items():
+        result.update(get_or_create_small_resources_of_model(model, resources))
+
+    return result
+
+
+def get_or_create_small_resources_of_model(model, resources, chunk_size=500):
+    """
+    Return dictionary {graph_id: pk} of instances of model, create absent ones using bulk_create.
+    Argument `resources` is a dictionary {graph_id: defaults}. Pks are stored in the identity map,
+    see get_or_create_from_small_resource()
+    """
+    def get_pks(graph_ids):
+        pks = {}
+        for i in range(0, len(graph_ids), chunk_size):
+            pks.update([(unicode(graph_id), pk) for graph_id, pk in model.objects.filter(
+                graph_id__in=graph_ids[i:i + chunk_size]).values_list('graph_id', 'pk')])
+        return pks
+
+    pks = get_pks(list(resources.keys()))
+    for graph_id, pk in pks.items():
+        small_resources_cache.set((model, graph_id), pk)
+
+    # rows are inserted in the same order by all processes to avoid deadlocks on unique index
+    graph_ids_absent = sorted([graph_id for graph_id in resources if graph_id not in pks])
+    if graph_ids_absent:
+        try:
+            with atomic():
+                model.objects.bulk_create([model(graph_id=graph_id, **resources[graph_id])
+                                           for graph_id in graph_ids_absent])
+        except IntegrityError:
+            # some of them were created by another process in the meantime, create the rest one by one
+            for graph_id in graph_ids_absent:
+                model.objects.get_or_create(graph_id=graph_id, defaults=resources[graph_id])
+        pks_created = get_pks(graph_ids_absent)
+        pks.update(pks_created)
+
+        # created objects will disappear after rollback of transaction, so cache them only outside of transaction
+        if not connections[router.db_for_write(model)].in_atomic_block:
+            for graph_id, pk in pks_created.items():
+                small_resources_cache.set((model, graph_id), pk)
+
+    return pks
+
+
+def get_lock_key(instance, name):
+    return 'facebook_api_lock:%s:%s:%s' % (instance._meta.db_table, name, instance.pk)
+
+
+@contextmanager
+def lock_object(instance, name, using=None):
+    """
+    Open short transaction for saving of relations `name` of instance. Depending on setting
+    FACEBOOK_API_INGESTION_LOCK transactions of concurrent processes for the same instance and relations
+    are serialized using transaction-level advisory lock of PostgreSQL or lock in Django cache
+    """
+    using = using or router.db_for_write(instance.__class__, instance=instance)
+    key = get_lock_key(instance, name)
+
+    if INGESTION_LOCK == 'cache':
+        from django.core.cache import caches
+        cache = caches[INGESTION_LOCK_CACHE_ALIAS]
+        # lock expires by itself after timeout, if process holding it died, so it's released only by its owner
+        token = uuid.uuid4().hex
+        started = time.time()
+        while not cache.add(key, token, INGESTION_LOCK_TIMEOUT):
+            if time.time() - started > INGESTION_LOCK_ACQUIRE_TIMEOUT:
+                raise LockTimeout("Lock '%s' was not acquired in %s secs" % (key, INGESTION_LOCK_ACQUIRE_TIMEOUT))
+            time.sleep(0.05)
+        try:
+            with atomic(using=using):
+                yield
+        finally:
+            if cache.get(key) == token:
+                cache.delete(key)
+
+    elif INGESTION_LOCK in [None, 'advisory']:
+        with atomic(using=using):
+            if INGESTION_LOCK == 'advisory' and connections[using].vendor == 'postgresql':
+                # lock is released automatically at the end of transaction
+                connections[using].cursor().execute('SELECT pg_advisory_xact_lock(%s)', [zlib.crc32(key)])
+            yield
+
+    else:
+        raise ImproperlyConfigured("Setting FACEBOOK_API_INGESTION_LOCK should be None, 'advisory' or 'cache', "
+                                   "not %s" % INGESTION_LOCK)
+
+
+def invalidate_small_resource(model, graph_id):
+    """
+    Remove instance from the cache of get_or_create_from_small_resource()
+    """
+    small_resources_cache.delete((model, unicode(graph_id)))
+
+
+def invalidate_deleted_small_resource(sender, instance, **kwargs):
+    graph_id = getattr(instance, 'graph_id', None)
+    if graph_id is not None and (sender, unicode(graph_id)) in small_resources_cache:
+        invalidate_small_resource(sender, graph_id)
+
+# only for models of small resources, receivers of any model disable fast deletion of its querysets
+for sender in ['facebook_applications.Application', 'facebook_pages.Page', 'facebook_users.User']:
+    post_delete.connect(invalidate_deleted_small_resource, sender=sender,
+                        dispatch_uid='facebook_api_invalidate_deleted_small_resource_%s' % sender)
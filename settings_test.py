@@ -1,2 +1,4 @@
-INSTALLED_APPS = ()
+INSTALLED_APPS = ('m2m_history', 'facebook_users')
 SOCIAL_API_TOKENS_STORAGES = []
+SOCIAL_API_CALL_CONTEXT = {}
+MIGRATION_MODULES = {'facebook_users': 'facebook_users.migrations_not_used_in_tests'}